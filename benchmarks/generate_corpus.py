@@ -0,0 +1,251 @@
+'''
+Generate a synthetic corpus of source files to benchmark conda_deps.
+
+The files are modeled on the examples in the tests folder: pipeline
+scripts like tests/pipeline_rnaseqqc.py, Jupyter notebooks like
+tests/notebook_example.ipynb (optionally with large embedded figures)
+and R scripts and R Markdown documents loading libraries.
+
+Usage:
+
+    python benchmarks/generate_corpus.py --files 10000 </path/to/corpus>
+'''
+
+import os
+import sys
+import json
+import base64
+import random
+import argparse
+
+# modules imported by the generated Python code
+PY_STD = ['os', 'sys', 're', 'sqlite3', 'itertools', 'collections',
+          'gzip', 'json', 'subprocess', 'os.path']
+
+PY_THIRD_PARTY = ['numpy', 'pandas', 'pysam', 'yaml', 'ruffus',
+                  'matplotlib.pyplot', 'scipy.stats', 'seaborn',
+                  'sklearn.decomposition', 'cgatcore.pipeline',
+                  'cgatcore.experiment', 'cgatcore.iotools',
+                  'cgatpipelines.tasks.mapping', 'rpy2.robjects', 'Bio.SeqIO']
+
+# libraries loaded by the generated R code
+R_LIBRARIES = ['ggplot2', 'reshape2', 'RColorBrewer', 'Hmisc', 'GMD',
+               'edgeR', 'limma', 'dplyr', 'gplots', 'knitr']
+
+PY_TASK = '''
+
+@transform({input!r}, suffix(".bam"), ".{name}.tsv")
+def {name}(infile, outfile):
+    \'\'\'compute {name} for each input file\'\'\'
+
+    statement = """cgat bam2stats
+                   --force-output
+                   < %(infile)s
+                   > %(outfile)s"""
+    job_memory = "{memory}G"
+    counts = collections.Counter()
+    for line in iotools.open_file(infile):
+        counts[line.split("\\t")[0]] += 1
+    P.run(statement)
+'''
+
+R_BLOCK = '''
+{name} <- read.table("{name}.tsv", header=TRUE, sep="\\t")
+{name}.m <- melt({name})
+g <- ggplot(data={name}.m, aes(factor(Name), y=value, fill=variable)) +
+    geom_bar(stat="identity") +
+    theme(axis.text.x=element_text(angle=90))
+ggsave(g, file="{name}.png")
+'''
+
+
+def python_imports(rnd):
+    '''
+       Auxiliary function to get a block of import statements
+    '''
+
+    modules = rnd.sample(PY_STD, 4) + rnd.sample(PY_THIRD_PARTY, 6)
+    lines = []
+    for m in modules:
+        if '.' in m and rnd.random() < 0.5:
+            (parent, child) = m.rsplit('.', 1)
+            lines.append('from {} import {}'.format(parent, child))
+        else:
+            lines.append('import {}'.format(m))
+    return '\n'.join(lines) + '\n'
+
+
+def python_file(rnd, size):
+    '''
+       Auxiliary function to get the source of a pipeline script
+    '''
+
+    parts = ['"""\nSynthetic pipeline generated to benchmark conda_deps\n"""\n\n',
+             'from ruffus import transform, suffix, merge\n',
+             python_imports(rnd)]
+    length = sum(map(len, parts))
+    task = 0
+    while length < size:
+        part = PY_TASK.format(input='*.bam', name='task{}'.format(task),
+                              memory=rnd.randint(1, 16))
+        parts.append(part)
+        length += len(part)
+        task += 1
+    return ''.join(parts)
+
+
+def r_file(rnd, size, markdown=False):
+    '''
+       Auxiliary function to get the source of an R script
+       or an R Markdown document
+    '''
+
+    libraries = ''.join('library({})\n'.format(l)
+                        for l in rnd.sample(R_LIBRARIES, 4))
+    parts = []
+    if markdown:
+        parts.append('---\ntitle: "Synthetic report"\noutput: html_document\n---\n\n')
+        parts.append('```{r setup}\n' + libraries + '```\n')
+    else:
+        parts.append(libraries)
+    length = sum(map(len, parts))
+    block = 0
+    while length < size:
+        part = R_BLOCK.format(name='table{}'.format(block))
+        if markdown:
+            part = '\nSome text about table{}.\n\n```{{r}}{}```\n'.format(block, part)
+        parts.append(part)
+        length += len(part)
+        block += 1
+    return ''.join(parts)
+
+
+def notebook_file(rnd, size, output_size=0):
+    '''
+       Auxiliary function to get a Jupyter notebook (nbformat v4).
+       When "output_size" is given, code cells have an embedded
+       figure of roughly that many bytes
+    '''
+
+    def code_cell(source):
+        cell = {'cell_type': 'code',
+                'execution_count': None,
+                'metadata': {},
+                'outputs': [],
+                'source': source.splitlines(True)}
+        if output_size > 0:
+            png = base64.b64encode(os.urandom(output_size * 3 // 4)).decode()
+            cell['outputs'].append({'output_type': 'display_data',
+                                    'metadata': {},
+                                    'data': {'image/png': png,
+                                             'text/plain': ['<Figure>']}})
+        return cell
+
+    def markdown_cell(source):
+        return {'cell_type': 'markdown',
+                'metadata': {},
+                'source': source.splitlines(True)}
+
+    cells = [markdown_cell('Synthetic report\n================\n'),
+             code_cell(python_imports(rnd) + '%matplotlib inline\n'),
+             code_cell('%load_ext rpy2.ipython\n')]
+    length = 0
+    block = 0
+    while length < size:
+        name = 'table{}'.format(block)
+        source = '{0} = pd.read_csv("{0}.tsv", sep="\\t")\n{0}.describe()\n'.format(name)
+        r_source = '%%R -i {} -w 600 -h 600 -u px\nlibrary("{}")\n{}'.format(
+            name, rnd.choice(R_LIBRARIES), R_BLOCK.format(name=name))
+        cells.append(markdown_cell('Now lets look at {}\n'.format(name)))
+        cells.append(code_cell(source))
+        cells.append(code_cell(r_source))
+        length += len(source) + len(r_source)
+        block += 1
+
+    notebook = {'cells': cells,
+                'metadata': {'kernelspec': {'display_name': 'Python 3',
+                                            'language': 'python',
+                                            'name': 'python3'}},
+                'nbformat': 4,
+                'nbformat_minor': 2}
+    return json.dumps(notebook, indent=1)
+
+
+def generate_corpus(folder, files, size=8192, output_size=0,
+                    notebook_outputs=0.5, files_per_folder=100, seed=0):
+    '''
+       Create a tree with "files" source files in "folder". Files
+       are spread in folders of "files_per_folder" files each, with
+       a mix of Python (70%), notebooks (10%), R (10%) and R Markdown
+       (10%). A fraction "notebook_outputs" of the notebooks have
+       embedded figures of "output_size" bytes in each code cell
+    '''
+
+    rnd = random.Random(seed)
+
+    for i in range(files):
+        subfolder = os.path.join(folder, 'module{}'.format(i // files_per_folder))
+        if i % files_per_folder == 0:
+            os.makedirs(subfolder, exist_ok=True)
+
+        kind = i % 10
+        if kind < 7:
+            name = 'script{}.py'.format(i)
+            data = python_file(rnd, size)
+        elif kind == 7:
+            name = 'report{}.ipynb'.format(i)
+            outputs = output_size if rnd.random() < notebook_outputs else 0
+            data = notebook_file(rnd, size, outputs)
+        elif kind == 8:
+            name = 'plots{}.R'.format(i)
+            data = r_file(rnd, size)
+        else:
+            name = 'report{}.Rmd'.format(i)
+            data = r_file(rnd, size, markdown=True)
+
+        with open(os.path.join(subfolder, name), 'w') as f:
+            f.write(data)
+
+
+def main(argv=None):
+    """script main.
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic corpus to benchmark conda_deps.')
+
+    parser.add_argument("folder", help="Path to the folder to create")
+    parser.add_argument("--files",
+                        help="Number of files to generate",
+                        type=int,
+                        default=1000)
+    parser.add_argument("--size",
+                        help="Approximate size of the source in each file, in bytes",
+                        type=int,
+                        default=8192)
+    parser.add_argument("--output-size",
+                        help="Size of the figures embedded in notebook outputs, in bytes",
+                        type=int,
+                        default=0)
+    parser.add_argument("--notebook-outputs",
+                        help="Fraction of notebooks with embedded figures",
+                        type=float,
+                        default=0.5)
+    parser.add_argument("--seed",
+                        help="Seed for the random number generator",
+                        type=int,
+                        default=0)
+
+    options = parser.parse_args(argv[1:])
+
+    generate_corpus(options.folder, options.files, options.size,
+                    options.output_size, options.notebook_outputs,
+                    seed=options.seed)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
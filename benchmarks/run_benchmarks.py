@@ -0,0 +1,134 @@
+'''
+Benchmark conda_deps on synthetic corpora of increasing size.
+
+For each size, a corpus is generated with generate_corpus.py (or
+reused if it already exists in the work folder) and check_deps is
+timed in a fresh process, both without a cache and with a warm
+cache. Wall time, files per second and peak RSS are reported.
+
+Usage:
+
+    python benchmarks/run_benchmarks.py --sizes 1000,10000,100000
+'''
+
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import tempfile
+import subprocess
+
+import generate_corpus
+
+# make the conda_deps package importable when running from a checkout
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def measure(folder, jobs, cache_dir):
+    '''
+       Scan "folder" in this process and return the number of files,
+       the wall time and the peak RSS of this process and its workers
+    '''
+
+    from conda_deps import conda_deps
+
+    cache = None
+    if cache_dir is not None:
+        cache = conda_deps.ScanCache(cache_dir)
+
+    start = time.perf_counter()
+    scan_files = conda_deps.collect_files(folder, [])
+    conda_deps.PY_LOCAL = conda_deps.get_local_imports(folder, scan_files)
+    conda_deps.scan_all_files(scan_files, jobs, cache)
+    if cache is not None:
+        cache.close()
+    seconds = time.perf_counter() - start
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+              resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) * scale
+
+    return {'files': len(scan_files), 'seconds': seconds, 'rss': rss}
+
+
+def run_measure(folder, jobs, cache_dir=None):
+    '''
+       Run measure() in a fresh Python process
+    '''
+
+    command = [sys.executable, os.path.abspath(__file__),
+               '--measure', folder, '--jobs', str(jobs)]
+    if cache_dir is not None:
+        command.extend(['--cache-dir', cache_dir])
+    output = subprocess.run(command, check=True, stdout=subprocess.PIPE,
+                            universal_newlines=True).stdout
+    return json.loads(output)
+
+
+def main(argv=None):
+    """script main.
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    parser = argparse.ArgumentParser(
+        description='Benchmark conda_deps on synthetic corpora.')
+
+    parser.add_argument("--sizes",
+                        help="Comma separated number of files in each corpus",
+                        default="1000,10000,100000")
+    parser.add_argument("--workdir",
+                        help="Folder to keep the generated corpora",
+                        default=os.path.join(tempfile.gettempdir(),
+                                             'conda_deps_benchmarks'))
+    parser.add_argument("--size",
+                        help="Approximate size of the source in each file, in bytes",
+                        type=int,
+                        default=8192)
+    parser.add_argument("--output-size",
+                        help="Size of the figures embedded in notebook outputs, in bytes",
+                        type=int,
+                        default=1 << 20)
+    parser.add_argument("--jobs",
+                        help="Number of processes used to scan files",
+                        type=int,
+                        default=os.cpu_count() or 1)
+    parser.add_argument("--measure", help=argparse.SUPPRESS)
+    parser.add_argument("--cache-dir", help=argparse.SUPPRESS)
+
+    options = parser.parse_args(argv[1:])
+
+    if options.measure:
+        json.dump(measure(options.measure, options.jobs, options.cache_dir),
+                  sys.stdout)
+        return
+
+    print('{:>8} {:<6} {:>10} {:>12} {:>10}'.format(
+        'files', 'cache', 'seconds', 'files/sec', 'RSS (MB)'))
+
+    for size in map(int, options.sizes.split(',')):
+        folder = os.path.join(options.workdir, 'corpus-{}'.format(size))
+        if not os.path.isdir(folder):
+            generate_corpus.generate_corpus(folder, size, options.size,
+                                            options.output_size)
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            runs = [('none', run_measure(folder, options.jobs)),
+                    ('cold', run_measure(folder, options.jobs, cache_dir)),
+                    ('warm', run_measure(folder, options.jobs, cache_dir))]
+
+        for (cache, result) in runs:
+            print('{:>8} {:<6} {:>10.3f} {:>12.1f} {:>10.1f}'.format(
+                result['files'], cache, result['seconds'],
+                result['files'] / result['seconds'],
+                result['rss'] / (1 << 20)))
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,263 @@
+'''
+Asynchronous scans, for services built on asyncio. Nothing is done
+in the event loop itself: folders are walked in threads, files are
+read and parsed by worker processes, and the cache is used from a
+thread of its own, so many scans can run concurrently in a single
+process. Cancelling a scan cancels the files still waiting for a
+worker.
+
+Usage:
+
+    async def audit(folders):
+        scanner = AsyncScanner(Scanner(cache=ScanCache(get_cache_folder())))
+        try:
+            return await asyncio.gather(*[scanner.scan(f) for f in folders])
+        finally:
+            scanner.close()
+'''
+
+import time
+import logging
+import asyncio
+import concurrent.futures
+
+from .conda_deps import (Scanner, ScanRecord, is_archive, get_language,
+                         get_local_imports, extract_files, merge_results,
+                         resolve_deps, lookup_cache, store_cache, init_worker)
+
+# files sent to a worker at a time, to keep the overhead
+# of inter-process communication low
+CHUNK_SIZE = 32
+
+
+class AsyncScanner:
+    '''
+       Runs the scans of a Scanner from coroutines, using its
+       translation tables, exclusions and cache, and its number of
+       jobs as the number of worker processes. Profiling is not
+       supported, and the local modules of the scanner are left
+       untouched, as several scans may run at the same time.
+
+       The CPU bound work is sent to "executor" if given (e.g. a
+       pool shared with other parts of a service), otherwise to a
+       pool of worker processes started on the first scan. Files are
+       sent in chunks of CHUNK_SIZE, and at most "limit" chunks or
+       archives are waiting for a worker or for the cache at any time,
+       across all the scans.
+    '''
+
+    def __init__(self, scanner=None, executor=None, limit=16):
+        if scanner is None:
+            scanner = Scanner()
+
+        self.scanner = scanner
+        self.executor = executor
+        self.own_executor = False
+        self.limit = limit
+        self.semaphore = None
+        # the cache is not thread safe, so it is only used from one thread
+        self.cache_thread = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def get_executor(self):
+        '''
+           Get the executor for the CPU bound work,
+           starting the worker processes if needed
+        '''
+
+        if self.executor is None:
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.scanner.jobs,
+                initializer=init_worker,
+                initargs=(logging.getLogger().isEnabledFor(logging.DEBUG),))
+            self.own_executor = True
+        return self.executor
+
+    def collect_all(self, filename, include_files, git):
+        '''
+           Get the files to scan and the local modules, as
+           Scanner.collect_all, without changing the scanner.
+           Runs in a thread, as walking folders blocks
+        '''
+
+        scan_files = []
+        blobs = {}
+        local_modules = set()
+        for f in [filename] + list(include_files):
+            if is_archive(f):
+                continue
+            (files, found) = self.scanner.collect(f, git)
+            if f == filename:
+                local_modules = get_local_imports(filename, files)
+            scan_files.extend(files)
+            blobs.update(found)
+        return scan_files, blobs, local_modules
+
+    def scan_archive(self, filename, executor):
+        '''
+           Scan an archive, as Scanner.scan_archives. Runs in a
+           thread, which reads the archive and hands its files to
+           the executor
+        '''
+
+        from . import archive
+        return archive.scan_archive(filename, self.scanner.exclude_folder,
+                                    self.scanner.default_excludes,
+                                    self.scanner.jobs, executor=executor)
+
+    def lookup_chunk(self, filenames, blobs):
+        '''
+           Look up a chunk of files in the cache. Returns a list of
+           tuples (filename, stats, cache key, cached result) for
+           each file. Runs in the thread of the cache
+        '''
+
+        cache = self.scanner.cache
+        if cache is None:
+            return [(f, None, None, None) for f in filenames]
+        return [(f,) + lookup_cache(cache, f, blobs.get(f)) for f in filenames]
+
+    def store_chunk(self, entries):
+        '''
+           Store the results of a chunk of files in the cache, given
+           as tuples (filename, stats, cache key, result, digest).
+           Runs in the thread of the cache
+        '''
+
+        for entry in entries:
+            store_cache(self.scanner.cache, *entry)
+
+    async def scan_chunk(self, filenames, blobs):
+        '''
+           Scan a chunk of files, looking them up in the cache first.
+           Returns a list of tuples (filename, result, seconds spent)
+        '''
+
+        loop = asyncio.get_running_loop()
+        cache = self.scanner.cache
+
+        start = time.perf_counter()
+        found = await loop.run_in_executor(self.cache_thread, self.lookup_chunk,
+                                           filenames, blobs)
+        seconds = (time.perf_counter() - start) / len(filenames)
+        done = [(f, cached, seconds) for (f, st, blob, cached) in found
+                if cached is not None]
+        pending = [entry[:3] for entry in found if entry[3] is None]
+        if not pending:
+            return done
+
+        (results, profile) = await loop.run_in_executor(
+            self.get_executor(), extract_files, [f for (f, st, blob) in pending],
+            cache is not None)
+
+        if cache is not None:
+            await loop.run_in_executor(
+                self.cache_thread, self.store_chunk,
+                [entry + (result, digest)
+                 for (entry, (result, digest, seconds)) in zip(pending, results)])
+        return done + [(f, result, seconds) for ((f, st, blob), (result, digest, seconds))
+                       in zip(pending, results)]
+
+    async def iter_results(self, filename, include_files, git, local_modules):
+        '''
+           Scan the files, yielding a tuple (filename, result, seconds
+           spent) for each one as soon as it is done. The local modules
+           of "filename" are added to the set "local_modules" before
+           the first result
+        '''
+
+        loop = asyncio.get_running_loop()
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.limit)
+
+        (scan_files, blobs, modules) = await loop.run_in_executor(
+            None, self.collect_all, filename, include_files, git)
+        local_modules.update(modules)
+
+        for f in [filename] + list(include_files):
+            if not is_archive(f):
+                continue
+            # an archive takes the place of a chunk while it is read
+            async with self.semaphore:
+                (found, modules) = await loop.run_in_executor(
+                    None, self.scan_archive, f, self.get_executor())
+            if f == filename:
+                local_modules.update(modules)
+            for (path, result) in found:
+                yield path, result, 0.0
+
+        running = set()
+        try:
+            for k in range(0, len(scan_files), CHUNK_SIZE):
+                await self.semaphore.acquire()
+                task = asyncio.ensure_future(self.scan_chunk(
+                    scan_files[k:k + CHUNK_SIZE], blobs))
+                # also when cancelled before it starts
+                task.add_done_callback(lambda task: self.semaphore.release())
+                running.add(task)
+                # hand over the files done so far, so results
+                # are not kept while waiting for the rest
+                done = {task for task in running if task.done()}
+                running -= done
+                for task in done:
+                    for result in task.result():
+                        yield result
+            while running:
+                (done, running) = await asyncio.wait(
+                    running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    for result in task.result():
+                        yield result
+        finally:
+            # when the scan is cancelled or the caller stops early
+            for task in running:
+                task.cancel()
+
+    async def iter_scan(self, filename, include_files=(), git=False):
+        '''
+           Scan a file, folder or archive, together with additional
+           files, folders or archives in "include_files", yielding a
+           ScanRecord for each file as soon as it is done, in no
+           particular order. See Scanner.iter_scan
+        '''
+
+        scanner = self.scanner
+        local_modules = set()
+        results = self.iter_results(filename, include_files, git, local_modules)
+        try:
+            async for (f, result, seconds) in results:
+                deps = resolve_deps(result['python'], result['r'], result['magics'],
+                                    scanner.py_deps, scanner.r_deps, local_modules)
+                yield ScanRecord(f, get_language(f), result, deps, seconds)
+        finally:
+            await results.aclose()
+
+    async def scan(self, filename, include_files=(), git=False):
+        '''
+           Scan a file, folder or archive, together with additional
+           files, folders or archives in "include_files". Local modules
+           are worked out from the first one. Returns the Python and
+           R dependencies
+        '''
+
+        scanner = self.scanner
+        local_modules = set()
+        results = []
+        async for (f, result, seconds) in self.iter_results(
+                filename, include_files, git, local_modules):
+            results.append(result)
+        (python_imports, r_imports, magics) = merge_results(results)
+        return resolve_deps(python_imports, r_imports, magics, scanner.py_deps,
+                            scanner.r_deps, local_modules)
+
+    def close(self):
+        '''
+           Stop the worker processes started by the scanner
+           and write pending entries of the cache
+        '''
+
+        if self.own_executor:
+            self.executor.shutdown()
+            self.executor = None
+            self.own_executor = False
+        self.cache_thread.shutdown()
+        self.scanner.close()
@@ -0,0 +1,197 @@
+'''
+Auxiliary functions to scan archives (e.g. source distributions,
+wheels or tarballs of pipelines) without extracting them. Members
+are streamed one at a time from the archive into the scanners.
+'''
+
+import os
+import logging
+import tarfile
+import zipfile
+import contextlib
+import concurrent.futures
+
+from .conda_deps import (IGNORE_FILE, SCAN_EXTENSIONS, NO_PROFILE,
+                         filter_files, get_folder_filter, parse_ignore_file,
+                         decode_file, get_local_modules, extract_all_data,
+                         init_worker)
+
+
+def clean_member_name(name):
+    '''
+       Auxiliary function to get the path of an archive
+       member without leading "./" or "/"
+    '''
+
+    while name.startswith('./'):
+        name = name[2:]
+    return name.lstrip('/')
+
+
+def read_members(filename, wanted):
+    '''
+       Auxiliary function to go through the members of an archive in
+       the order they are stored. Tar archives are read in streaming
+       mode, so compressed archives are decompressed on the fly.
+
+       Yields a tuple (path, bytes) for each file in the archive,
+       where the contents are only read for the paths for which
+       "wanted" is true, and are None otherwise
+    '''
+
+    if filename.endswith(('.zip', '.whl')):
+        with zipfile.ZipFile(filename) as z:
+            for info in z.infolist():
+                if info.is_dir():
+                    continue
+                name = clean_member_name(info.filename)
+                yield name, z.read(info) if wanted(name) else None
+    else:
+        # https://docs.python.org/3/library/tarfile.html#tarfile.open
+        # "r|*" reads a stream of blocks with any compression
+        with tarfile.open(filename, mode='r|*') as tar:
+            for member in tar:
+                if not member.isfile():
+                    continue
+                name = clean_member_name(member.name)
+                data = None
+                if wanted(name):
+                    with tar.extractfile(member) as f:
+                        data = f.read()
+                yield name, data
+
+
+def get_top_folder(names):
+    '''
+       Auxiliary function to get the folder holding all the files
+       of an archive (e.g. "pkg-1.0" in a source distribution),
+       or an empty string if there is none
+    '''
+
+    tops = {n.partition('/')[0] for n in names}
+    if len(tops) == 1 and all('/' in n for n in names):
+        return tops.pop()
+    return ''
+
+
+def scan_archive(filename, exclude_folder, default_excludes=True, jobs=1,
+                 profile=None, executor=None):
+    '''
+       Auxiliary function to extract the raw names from the files
+       in an archive (.tar, .tar.gz, .tar.bz2, .tar.xz, .zip or
+       .whl), dispatching on the extension of each member like
+       for files on disk. Nothing is written to disk and only one
+       member is kept in memory at a time for each worker process.
+
+       Exclusions are applied the same way as in collect_files,
+       taking paths from the top folder of the archive (if any),
+       where the .condadepsignore file is read from as well.
+
+       Files are scanned with "executor" if given, otherwise with a
+       pool of "jobs" worker processes, or in this process if "jobs"
+       is 1. At most "jobs" times 4 files wait for a worker.
+
+       Returns a list of tuples (path, result) for the files to scan,
+       where the path starts with the path of the archive, and the
+       local modules defined by the Python files in the archive
+    '''
+
+    if profile is None:
+        profile = NO_PROFILE
+
+    # paths of all the files, to find out which ones are excluded
+    # once the archive has been read
+    names = []
+    ignore_files = {}
+    results = {}
+
+    # members in excluded folders are not read, taking paths from
+    # the top folder of the first member until a member outside of
+    # it shows up. Exclusions are applied again once all the paths
+    # are known, and members that were left out by mistake are read
+    # in a second pass (e.g. when there is no top folder)
+    guess = {'top': None, 'is_excluded': None}
+
+    def is_excluded(name):
+        top = guess['top']
+        if top is None:
+            # first member
+            top = name.partition('/')[0] if '/' in name else ''
+        elif top and not name.startswith(top + '/'):
+            # there is no top folder after all
+            top = ''
+        if top != guess['top']:
+            guess['top'] = top
+            guess['is_excluded'] = None
+        if guess['is_excluded'] is None:
+            ignore_patterns = []
+            if top in ignore_files:
+                ignore_patterns = parse_ignore_file(
+                    decode_file(ignore_files[top]).splitlines())
+            guess['is_excluded'] = get_folder_filter(
+                os.path.join(filename, top), exclude_folder,
+                default_excludes, ignore_patterns)
+        start = len(top) + 1 if top else 0
+        return guess['is_excluded'](name[start:].rpartition('/')[0])
+
+    def wanted(name):
+        if os.path.basename(name) == IGNORE_FILE:
+            return True
+        return name.endswith(SCAN_EXTENSIONS) and not is_excluded(name)
+
+    def contents(members):
+        for (name, data) in members:
+            names.append(name)
+            if data is None:
+                continue
+            if os.path.basename(name) == IGNORE_FILE:
+                ignore_files[os.path.dirname(name)] = data
+                if os.path.dirname(name) == guess['top']:
+                    guess['is_excluded'] = None
+                continue
+            logging.debug('Scanning {} in {}'.format(name, filename))
+            yield name, os.path.join(filename, name), data
+
+    def scan(members):
+        scanned = len(results)
+        with profile.phase('scan'):
+            with contextlib.ExitStack() as stack:
+                pool = executor
+                if pool is None and jobs > 1:
+                    pool = stack.enter_context(concurrent.futures.ProcessPoolExecutor(
+                        max_workers=jobs,
+                        initializer=init_worker,
+                        initargs=(logging.getLogger().isEnabledFor(logging.DEBUG),)))
+                for (name, result) in extract_all_data(contents(members), pool,
+                                                       jobs * 4, profile):
+                    results[name] = result
+        if profile.enabled:
+            profile.files['scan'] += len(results) - scanned
+
+    scan(read_members(filename, wanted))
+
+    top = get_top_folder(names)
+    folder = os.path.join(filename, top)
+    start = len(top) + 1 if top else 0
+
+    ignore_patterns = []
+    if top in ignore_files:
+        ignore_patterns = parse_ignore_file(
+            decode_file(ignore_files[top]).splitlines())
+
+    paths = filter_files(folder, sorted(n[start:] for n in names),
+                         exclude_folder, default_excludes, ignore_patterns)
+
+    members = [top + '/' + p if top else p for p in paths]
+    missing = set(members) - set(results)
+    if missing:
+        logging.debug('Reading {} files again from {}'.format(len(missing), filename))
+        scan(read_members(filename, lambda name: name in missing))
+
+    logging.debug('Found {} files to scan in {}'.format(len(paths), filename))
+
+    local_modules = get_local_modules(folder, [os.path.join(folder, p)
+                                               for p in paths])
+
+    return [(os.path.join(folder, p), results[m])
+            for (p, m) in zip(paths, members)], local_modules
@@ -0,0 +1,81 @@
+'''
+Thin client for conda_deps serve. It sends the command line to the
+daemon over a Unix domain socket and prints the results, so scans do
+not pay for starting up conda_deps. Only modules from the standard
+library that are loaded anyway are imported here. When no daemon is
+running, the scan is done in this process instead.
+
+Usage:
+
+    conda_deps_client [conda_deps options] </path/to/folder>
+'''
+
+import os
+import sys
+import json
+import socket
+
+
+def get_socket_path():
+    '''
+       Auxiliary function to get the default path of the socket
+       of the daemon: $CONDA_DEPS_SOCKET if set, otherwise a file
+       in $XDG_RUNTIME_DIR or in the cache folder of conda_deps
+    '''
+
+    if os.environ.get('CONDA_DEPS_SOCKET'):
+        return os.environ['CONDA_DEPS_SOCKET']
+
+    folder = os.environ.get('XDG_RUNTIME_DIR')
+    if not folder:
+        cache_home = os.environ.get('XDG_CACHE_HOME',
+                                    os.path.join(os.path.expanduser('~'), '.cache'))
+        folder = os.path.join(cache_home, 'conda_deps')
+    return os.path.join(folder, 'conda_deps.sock')
+
+
+def send_request(path, request):
+    '''
+       Auxiliary function to send a request to the daemon listening
+       on "path" and get its response. Both are JSON documents; the
+       request ends when the client shuts down its side of the socket
+    '''
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(path)
+        s.sendall(json.dumps(request).encode())
+        s.shutdown(socket.SHUT_WR)
+        data = []
+        while True:
+            block = s.recv(1 << 16)
+            if not block:
+                break
+            data.append(block)
+    return json.loads(b''.join(data).decode())
+
+
+def main(argv=None):
+    """script main.
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    path = get_socket_path()
+    request = {'argv': argv[1:], 'cwd': os.getcwd()}
+
+    try:
+        response = send_request(path, request)
+    except (FileNotFoundError, ConnectionRefusedError):
+        # no daemon running
+        from .conda_deps import main as scan
+        return scan(['conda_deps'] + argv[1:])
+
+    sys.stdout.write(response['stdout'])
+    sys.stderr.write(response['stderr'])
+    return response['status']
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -12,23 +12,68 @@ if (sys.version_info < (3, 0, 0)):
     sys.exit(-1)
 
 import os
+import io
 import shutil
-import importlib.util
 import re
 import ast
 import argparse
+import functools
+import sysconfig
 import json
 import logging
-import nbformat
-from nbconvert import PythonExporter
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import sqlite3
+import time
+import itertools
+import subprocess
+import tokenize
+
+__version__ = "0.0.9"
 
 # modules part of the Python Standard Library
 PY_STD = {'sys',
           'builtins',
           'xml'}
 
+# all modules part of the Python Standard Library,
+# computed the first time they are needed
+PY_STD_MODULES = None
+
+# assignments from IPython magics and shell commands (e.g. files = !ls)
+IPYTHON_ASSIGNMENT = re.compile(r"^(\s*[\w\.\[\], ]+=\s*)[%!].*$")
+
+# requests for help in IPython (e.g. numpy.sum? or ?numpy.sum)
+IPYTHON_HELP = re.compile(r"^(\?{1,2}[\w\.]+|[\w\.]+\?{1,2})$")
+
+# extensions of the files to scan
+SCAN_EXTENSIONS = ('.py', '.R', '.Rmd', '.ipynb')
+
+# phases reported by --profile, in order
+PROFILE_PHASES = ('walk', 'cache', 'scan', 'read', 'python', 'jupyter',
+                  'r', 'magics', 'resolve', 'output')
+
+# characters with a special meaning in glob patterns
+GLOB_CHARS = re.compile(r"[\*\?\[]")
+
+# folders left out of scans by default, as they never have source code:
+# version control, caches, checkpoints, workflow managers' metadata and
+# output folders of CGAT pipelines (*.dir)
+DEFAULT_EXCLUDES = ('.git', '.hg', '.svn', '__pycache__', '.ipynb_checkpoints',
+                    '.snakemake', '.nextflow', 'node_modules', '.tox', '.nox',
+                    '.mypy_cache', '.pytest_cache', '*.egg-info', '*.dir')
+
+# archives that can be scanned without extracting them
+ARCHIVE_EXTENSIONS = ('.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz',
+                      '.txz', '.tar', '.zip', '.whl')
+
+# project-level file with folders to leave out of scans
+IGNORE_FILE = '.condadepsignore'
+
 # Python files located inside the folder to scan
-PY_LOCAL = []
+PY_LOCAL = set()
 
 # load translations for Python deps from default json file
 (py_deps_folder, py_deps_file) = os.path.split(__file__)
@@ -62,6 +107,344 @@ def config_logging(debug):
         rootLogger.setLevel(logging.DEBUG)
 
 
+def get_cache_folder():
+    '''
+       Auxiliary function to get the default folder
+       for the persistent scan cache
+    '''
+
+    cache_home = os.environ.get('XDG_CACHE_HOME',
+                                os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(cache_home, 'conda_deps')
+
+
+def file_digest(filename):
+    '''
+       Auxiliary function to compute a hash of the contents of a file
+    '''
+
+    digest = hashlib.blake2b(digest_size=20)
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def python_tag():
+    '''
+       Auxiliary function to identify the Python interpreter, as the
+       ast module only parses the grammar of its own version (e.g. a
+       match statement is a syntax error before Python 3.10)
+    '''
+
+    return '{}-{}.{}'.format(sys.implementation.name, *sys.version_info[:2])
+
+
+def scanner_fingerprint():
+    '''
+       Auxiliary function to identify the version of the scanners,
+       so cached results are discarded whenever this tool or the
+       Python interpreter changes
+    '''
+
+    with open(__file__, 'rb') as f:
+        source = f.read()
+    return '{}:{}:{}'.format(__version__, python_tag(),
+                             hashlib.blake2b(source, digest_size=20).hexdigest())
+
+
+class ScanCache:
+    '''
+       Persistent cache with the raw names found in each file by
+       the scanners, stored in a SQLite database. As translations
+       are applied afterwards, changes to the translation tables
+       do not invalidate the cache.
+
+       Entries are validated with the size and modification time
+       of the file. Optionally, when those differ, a hash of the
+       contents is used to recognise files that did not change
+       (e.g. after a fresh checkout).
+
+       Each Python version has a database of its own, so conda
+       environments sharing the cache folder do not discard the
+       entries of each other.
+    '''
+
+    def __init__(self, folder, use_hash=False):
+        os.makedirs(folder, exist_ok=True)
+        # the cache can be used from another thread than the one that
+        # opened it (see aio.AsyncScanner), but only one at a time
+        self.db = sqlite3.connect(
+            os.path.join(folder, 'scan_cache-{}.sqlite'.format(python_tag())),
+            timeout=30, check_same_thread=False)
+        self.use_hash = use_hash
+        self.pending = []
+        self.pending_blobs = []
+
+        self.db.execute('''CREATE TABLE IF NOT EXISTS meta (
+                               key TEXT PRIMARY KEY,
+                               value TEXT)''')
+
+        # discard all entries produced by a different version of the scanners
+        fingerprint = scanner_fingerprint()
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'fingerprint'").fetchone()
+        if row is None or row[0] != fingerprint:
+            logging.debug('Discarding scan cache in {}'.format(folder))
+            self.db.execute("DROP TABLE IF EXISTS files")
+            self.db.execute("DROP TABLE IF EXISTS blobs")
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('fingerprint', ?)",
+                            (fingerprint,))
+
+        self.db.execute('''CREATE TABLE IF NOT EXISTS files (
+                               path TEXT PRIMARY KEY,
+                               size INTEGER,
+                               mtime_ns INTEGER,
+                               digest TEXT,
+                               result TEXT)''')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS blobs (
+                               blob TEXT PRIMARY KEY,
+                               result TEXT)''')
+        self.db.commit()
+
+    def get(self, filename, st):
+        '''
+           Return the cached scan result for a file
+           or None if there is no valid entry
+        '''
+
+        path = os.path.abspath(filename)
+        row = self.db.execute('''SELECT size, mtime_ns, digest, result
+                                 FROM files WHERE path = ?''',
+                              (path,)).fetchone()
+        if row is None:
+            return None
+
+        (size, mtime_ns, digest, result) = row
+        if size != st.st_size or mtime_ns != st.st_mtime_ns:
+            if not self.use_hash or digest is None or \
+                    digest != file_digest(filename):
+                return None
+            # contents did not change, refresh the entry
+            self.pending.append((path, st.st_size, st.st_mtime_ns,
+                                 digest, result))
+
+        logging.debug('Using cached scan for file: {}'.format(filename))
+
+        return json.loads(result)
+
+    def put(self, filename, st, result, digest):
+        '''
+           Store the scan result for a file, together
+           with the hash of its contents
+        '''
+
+        self.pending.append((os.path.abspath(filename),
+                             st.st_size, st.st_mtime_ns, digest,
+                             json.dumps(result)))
+
+    def get_blob(self, blob):
+        '''
+           Return the cached scan result for the contents of a file
+           given its git object ID, or None if there is no entry
+        '''
+
+        row = self.db.execute("SELECT result FROM blobs WHERE blob = ?",
+                              (blob,)).fetchone()
+        if row is None:
+            return None
+
+        logging.debug('Using cached scan for blob: {}'.format(blob))
+
+        return json.loads(row[0])
+
+    def put_blob(self, blob, result):
+        '''
+           Store the scan result for the contents of
+           a file given its git object ID
+        '''
+
+        self.pending_blobs.append((blob, json.dumps(result)))
+
+    def close(self):
+        '''
+           Write pending entries to disk and close the database
+        '''
+
+        self.flush()
+        self.db.close()
+
+    def flush(self):
+        '''
+           Write pending entries to disk
+        '''
+
+        try:
+            with self.db:
+                self.db.executemany('''INSERT OR REPLACE INTO files
+                                       VALUES (?, ?, ?, ?, ?)''',
+                                    self.pending)
+                self.db.executemany('''INSERT OR REPLACE INTO blobs
+                                       VALUES (?, ?)''',
+                                    self.pending_blobs)
+        except sqlite3.Error as e:
+            logging.warning("Could not update scan cache: {}".format(e))
+        self.pending = []
+        self.pending_blobs = []
+
+
+class MemoryCache:
+    '''
+       Cache with the same interface as ScanCache that keeps the
+       results in memory, for long running processes (e.g. conda_deps
+       serve). When a ScanCache is given in "backing", results missing
+       from memory are looked up there and new ones are stored there
+       too. At most "max_entries" files and objects are kept in memory,
+       dropping the ones that were stored first
+    '''
+
+    def __init__(self, backing=None, max_entries=1000000):
+        self.backing = backing
+        self.max_entries = max_entries
+        # path -> (size, modification time, result)
+        self.files = {}
+        self.blobs = {}
+
+    def _store(self, table, key, value):
+        table.pop(key, None)
+        table[key] = value
+        while len(table) > self.max_entries:
+            del table[next(iter(table))]
+
+    def get(self, filename, st):
+        path = os.path.abspath(filename)
+        entry = self.files.get(path)
+        if entry is not None and entry[:2] == (st.st_size, st.st_mtime_ns):
+            logging.debug('Using cached scan for file: {}'.format(filename))
+            return entry[2]
+        if self.backing is None:
+            return None
+        result = self.backing.get(filename, st)
+        if result is not None:
+            self._store(self.files, path, (st.st_size, st.st_mtime_ns, result))
+        return result
+
+    def put(self, filename, st, result, digest):
+        self._store(self.files, os.path.abspath(filename),
+                    (st.st_size, st.st_mtime_ns, result))
+        if self.backing is not None:
+            self.backing.put(filename, st, result, digest)
+
+    def get_blob(self, blob):
+        result = self.blobs.get(blob)
+        if result is not None:
+            logging.debug('Using cached scan for blob: {}'.format(blob))
+            return result
+        if self.backing is None:
+            return None
+        result = self.backing.get_blob(blob)
+        if result is not None:
+            self._store(self.blobs, blob, result)
+        return result
+
+    def put_blob(self, blob, result):
+        self._store(self.blobs, blob, result)
+        if self.backing is not None:
+            self.backing.put_blob(blob, result)
+
+    def close(self):
+        '''
+           Write pending entries of the backing cache to disk,
+           keeping it open for later scans
+        '''
+
+        if self.backing is not None:
+            self.backing.flush()
+
+
+class ContentMemo(dict):
+    '''
+       Results of the files scanned so far, by hash of their contents,
+       to reuse them for files with the same contents (see extract_file).
+       At most "max_entries" results are kept, dropping the ones that
+       were stored first, so memory does not grow with the number of
+       files in streaming scans
+    '''
+
+    def __init__(self, max_entries=10000):
+        super().__init__()
+        self.max_entries = max_entries
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        while len(self) > self.max_entries:
+            del self[next(iter(self))]
+
+
+class Profile:
+    '''
+       Time spent in each phase of a scan, together with
+       the number of files and bytes handled by each scanner
+    '''
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.seconds = collections.Counter()
+        self.files = collections.Counter()
+        self.bytes = collections.Counter()
+
+    def phase(self, name, size=None):
+        '''
+           Context manager to time a phase. When "size" is given,
+           it also counts one file of that many bytes
+        '''
+
+        if not self.enabled:
+            return contextlib.nullcontext()
+        return self._timer(name, size)
+
+    @contextlib.contextmanager
+    def _timer(self, name, size):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - start
+            if size is not None:
+                self.files[name] += 1
+                self.bytes[name] += size
+
+    def update(self, other):
+        '''
+           Add the counts of another profile, e.g. from a worker process
+        '''
+
+        self.seconds.update(other.seconds)
+        self.files.update(other.files)
+        self.bytes.update(other.bytes)
+
+    def report(self):
+        '''
+           Log a summary table. Logging goes to stderr,
+           so the environment file on stdout is not affected
+        '''
+
+        logging.info('{:<12} {:>10} {:>14} {:>10}'.format(
+            'Phase', 'Files', 'Bytes', 'Seconds'))
+        for name in PROFILE_PHASES:
+            if name not in self.seconds:
+                continue
+            files = self.files.get(name, '-')
+            size = self.bytes.get(name, '-')
+            logging.info('{:<12} {:>10} {:>14} {:>10.3f}'.format(
+                name, files, size, self.seconds[name]))
+        logging.info('Time spent by scanners is summed over all worker processes')
+        logging.info('Files with the same contents as another one, '
+                     'not parsed again: {}'.format(self.files['duplicate']))
+
+
+NO_PROFILE = Profile(enabled=False)
+
+
 def is_import(node):
     '''
        Auxiliary function to get import statements from
@@ -86,39 +469,46 @@ def is_import(node):
     return results
 
 
-# References:
-# https://bit.ly/2BXcW3l
-# https://docs.python.org/3/library/importlib.html
-def is_python_std(name):
+def get_python_std_modules():
     '''
-       Auxiliary function to test if a module is part
-       of Python's standard library or not
+       Auxiliary function to get the names of all the top level
+       modules in Python's standard library, without importing them
     '''
 
-    if name in PY_STD:
-        logging.debug('{} is part of Python Standard Library'.format(name))
-        return True
+    result = set(PY_STD)
+    result.update(sys.builtin_module_names)
 
-    result = False
+    if hasattr(sys, 'stdlib_module_names'):
+        # available since Python 3.10
+        result.update(sys.stdlib_module_names)
+    else:
+        # list the contents of the standard library folder instead
+        for folder in (sysconfig.get_path('stdlib'),
+                       os.path.join(sysconfig.get_path('stdlib'), 'lib-dynload')):
+            if not os.path.isdir(folder):
+                continue
+            for entry in os.listdir(folder):
+                name = entry.split('.')[0]
+                if name.isidentifier() and name != 'site-packages':
+                    result.add(name)
 
-    #python_path = os.path.dirname(sys.executable)
-    module_path = None
+    return frozenset(result)
 
-    try:
-        module_path = importlib.util.find_spec(name).origin
-    except BaseException:
-        pass
 
-    logging.debug('Module Name: {}'.format(name))
-    #logging.debug('Python Path: {}'.format(python_path))
-    logging.debug('Module Path: {}'.format(module_path))
+# References:
+# https://docs.python.org/3/library/sys.html#sys.stdlib_module_names
+@functools.lru_cache(maxsize=None)
+def is_python_std_module(name):
+    '''
+       Auxiliary function to test if a top level module is part
+       of Python's standard library or not. Results are memoized
+    '''
+
+    global PY_STD_MODULES
+    if PY_STD_MODULES is None:
+        PY_STD_MODULES = get_python_std_modules()
 
-    if module_path is not None:
-        result = ('site-packages' not in module_path and \
-            'dist-packages' not in module_path and \
-            '/lib/python3.' in module_path) or \
-            ('built-in' in module_path)
-            #python_path in module_path
+    result = name in PY_STD_MODULES
 
     logging.debug(
         'Is {} part of Python Standard Library? {}'.format(
@@ -127,23 +517,53 @@ def is_python_std(name):
     return result
 
 
-def get_local_imports(folder):
+def is_python_std(name):
+    '''
+       Auxiliary function to test if a module is part
+       of Python's standard library or not
+       (e.g. os.path -> True, matplotlib.pyplot -> False)
+    '''
+
+    return is_python_std_module(name.partition('.')[0])
+
+
+def get_local_imports(folder, scan_files=None, follow_symlinks=False):
     '''
        When scanning a folder, the import might refer
-       to a Python file inside the folder itself
+       to a Python file inside the folder itself.
+
+       The local modules are worked out from the list of files
+       found in the folder, which is collected if not given
+       (see collect_files for "follow_symlinks")
     '''
 
-    result = []
+    if not os.path.isdir(folder) or not os.access(folder, os.R_OK):
+        return set()
+
+    if scan_files is None:
+        scan_files = collect_files(folder, [], follow_symlinks=follow_symlinks)
+
+    return get_local_modules(folder, scan_files)
+
+
+def get_local_modules(folder, scan_files):
+    '''
+       Auxiliary function to get the modules and packages defined
+       by the Python files in a list of paths below "folder",
+       without looking at the file system (e.g. inside an archive)
+    '''
+
+    result = set()
+
+    for f in scan_files:
+        if f.endswith(".py"):
+            (dirpath, name) = os.path.split(f)
+            result.add(os.path.splitext(name)[0])
+            # packages inside the folder
+            if name == '__init__.py' and \
+                    os.path.normpath(dirpath) != os.path.normpath(folder):
+                result.add(os.path.basename(dirpath))
 
-    if os.path.isdir(folder) and os.access(folder, os.R_OK):
-        for dirpath, dirs, files in os.walk(folder):
-            for d in dirs:
-                full_dir = os.path.abspath(os.path.join(dirpath, d))
-                if os.path.exists(os.path.join(full_dir, '__init__.py')):
-                    result.append(d)
-            for f in files:
-                if f.endswith(".py"):
-                    result.append(os.path.splitext(f)[0])
     return result
 
 
@@ -157,7 +577,7 @@ def cleanup_import(name):
     return result.group(1)
 
 
-def translate_python_import(name):
+def translate_python_import(name, py_deps=None):
     '''
        Auxiliary function to translate the module name
        into its conda package (e.g. cgat -> cgat-apps)
@@ -170,97 +590,256 @@ def translate_python_import(name):
        python_deps.json will be growing over time as
        we find more cases where the package name and the
        import name differs
+
+       Another translation table can be given in "py_deps"
     '''
 
-    result = PY_DEPS.get(name, name)
+    if py_deps is None:
+        py_deps = PY_DEPS
+
+    result = py_deps.get(name, name)
 
     return result
 
 
-def scan_python_imports(filename):
+def read_file(filename):
     '''
-       Auxiliary function to get Python imports from a single file
+       Auxiliary function to read the contents of a file as text
     '''
     # check input is correct
     if not os.access(filename, os.R_OK):
         raise IOError("File {} can't be read\n".format(filename))
 
-    logging.debug('Python scan for file: {}'.format(filename))
+    with open(filename) as f:
+        return f.read()
 
-    deps = set()
+
+def decode_file(data):
+    '''
+       Auxiliary function to decode the contents of a file the
+       same way as open() would do in text mode
+    '''
+
+    return io.TextIOWrapper(io.BytesIO(data)).read()
+
+
+def get_python_imports(source):
+    '''
+       Auxiliary function to get the names of the modules imported
+       in Python source code, without any translation
+       (e.g. import matplotlib.pyplot -> matplotlib.pyplot)
+    '''
+
+    result = set()
 
     # parse script with Python's AST module:
     # https://docs.python.org/3/library/ast.html#module-ast
+    tree = ast.parse(source)
+
+    # inspired by
+    # http://bit.ly/2rDf5xu
+    # http://bit.ly/2r0Uv9t
+    # really helpful, used astviewer (installed in a conda-env) to inspect examples
+    # https://github.com/titusjan/astviewer
+    for node in ast.walk(tree):
+        # relative imports (e.g. from . import bla) are always local
+        if isinstance(node, ast.ImportFrom) and node.level > 0:
+            continue
+        modules = is_import(node)
+        if modules is not None:
+            result.update(modules)
+
+    return result
+
+
+def resolve_python_imports(names, py_deps=None, local_modules=None):
+    '''
+       Auxiliary function to translate the names of imported
+       modules into conda packages, leaving out modules from
+       Python's standard library and local modules.
+
+       Other translation tables and local modules than the
+       module-level ones can be given in "py_deps" and "local_modules"
+    '''
+
+    if local_modules is None:
+        local_modules = PY_LOCAL
+
+    deps = set()
+
+    for m in names:
+        if not is_python_std(m):
+            orig = cleanup_import(m)
+            tran = translate_python_import(orig, py_deps)
+            if tran != "ignore" and tran not in local_modules:
+                deps.add(tran)
+                logging.debug('Translating Python dependency {} into {}'.format(orig, tran))
+            else:
+                logging.debug('Ignoring Python dependency: {}'.format(orig))
+
+    return deps
+
+
+def scan_python_imports(filename, data=None):
+    '''
+       Auxiliary function to get Python imports from a single file.
+       The contents of the file can be given in "data" to avoid reading it
+    '''
+
+    logging.debug('Python scan for file: {}'.format(filename))
+
+    names = set()
+
     try:
-        with open(filename) as f:
-            tree = ast.parse(f.read())
-
-        # inspired by
-        # http://bit.ly/2rDf5xu
-        # http://bit.ly/2r0Uv9t
-        # really helpful, used astviewer (installed in a conda-env) to inspect examples
-        # https://github.com/titusjan/astviewer
-        for node in ast.walk(tree):
-            modules = is_import(node)
-            if modules is not None:
-                for m in modules:
-                    if not is_python_std(m):
-                        orig = cleanup_import(m)
-                        tran = translate_python_import(orig)
-                        if tran != "ignore" and tran not in PY_LOCAL:
-                            deps.add(tran)
-                            logging.debug('Translating Python dependency {} into {}'.format(orig, tran))
-                        else:
-                            logging.debug('Ignoring Python dependency: {}'.format(orig))
+        if data is None:
+            data = read_file(filename)
+
+        names = get_python_imports(data)
 
     except BaseException:
         logging.warning("Could not parse file: {}".format(filename))
 
-    return deps
+    return resolve_python_imports(names)
 
 
-def scan_jupyter_imports(filename):
+def get_notebook_cells(notebook, cell_type='code'):
     '''
-       Auxiliary function to get Python imports from Jupyter notebooks
+       Auxiliary function to get the source of the cells of a given
+       type from a Jupyter notebook, for nbformat v3 and v4:
+       https://nbformat.readthedocs.io/en/latest/format_description.html
+    '''
+
+    if notebook.get('nbformat', 4) >= 4:
+        cells = notebook.get('cells', [])
+        key = 'source'
+    else:
+        cells = [c for w in notebook.get('worksheets', [])
+                 for c in w.get('cells', [])]
+        key = 'input'
+
+    for cell in cells:
+        if cell.get('cell_type') == cell_type:
+            source = cell.get(key, '')
+            if isinstance(source, list):
+                source = ''.join(source)
+            yield source
+
+
+def ipython_to_python(source):
+    '''
+       Auxiliary function to turn the IPython syntax in a code cell
+       (magics, shell commands and help) into valid Python code
+    '''
+
+    # cell magics (e.g. %%R, %%bash) take over the whole cell
+    if source.lstrip().startswith('%%'):
+        return ''
+
+    lines = []
+    starts = get_logical_line_starts(source)
+    # whether the current logical line was a magic or a shell command
+    dropped = False
+    for (i, l) in enumerate(source.split('\n')):
+        if i not in starts:
+            # e.g. inside brackets or after a backslash
+            lines.append('' if dropped else l)
+            continue
+        stripped = l.lstrip()
+        indent = l[:len(l) - len(stripped)]
+        if stripped.startswith(('%', '!')) or \
+                IPYTHON_HELP.match(stripped):
+            # e.g. %matplotlib inline, !pwd or numpy.sum?
+            lines.append(indent + 'pass')
+            dropped = True
+        else:
+            # e.g. files = !ls
+            line = IPYTHON_ASSIGNMENT.sub(r'\1None', l)
+            lines.append(line)
+            dropped = line != l
+
+    return '\n'.join(lines)
+
+
+def get_logical_line_starts(source):
+    '''
+       Auxiliary function to get the numbers (from 0) of the lines
+       of a code cell that start a logical line, leaving out the ones
+       inside brackets or strings, or after a backslash, as IPython
+       does. When the cell can not be tokenized (e.g. a quote in a
+       shell command), the lines after the error are taken as starts
+    '''
+
+    starts = {0}
+    depth = 0
+    current = 0
+    try:
+        for tok in tokenize.generate_tokens(io.StringIO(source).readline):
+            if tok.type == tokenize.OP and tok.string in ('(', '[', '{'):
+                depth += 1
+            elif tok.type == tokenize.OP and tok.string in (')', ']', '}'):
+                depth -= 1
+            elif tok.type == tokenize.NEWLINE or \
+                    (tok.type == tokenize.NL and depth <= 0):
+                # rows start at 1, so this is the number of the next line
+                current = tok.end[0]
+                starts.add(current)
+                depth = 0
+    except (tokenize.TokenError, SyntaxError):
+        starts.update(range(current + 1, source.count('\n') + 1))
+
+    return starts
+
+
+def load_notebook(data):
+    '''
+       Auxiliary function to load the JSON contents of a Jupyter notebook
+    '''
+
+    notebook = json.loads(data)
+    if not isinstance(notebook, dict):
+        raise ValueError("Not a Jupyter notebook")
+    return notebook
+
+
+def get_jupyter_imports(notebook):
+    '''
+       Auxiliary function to get the names of the modules imported
+       in the code cells of a Jupyter notebook, without any translation
+    '''
+
+    # only the source of the code cells is needed
+    body = '\n\n'.join(ipython_to_python(c)
+                       for c in get_notebook_cells(notebook))
+
+    return get_python_imports(body)
+
+
+def scan_jupyter_imports(filename, data=None, notebook=None):
+    '''
+       Auxiliary function to get Python imports from Jupyter notebooks.
+       The contents of the file can be given in "data", or already
+       loaded in "notebook", to avoid reading it
     '''
-    # check input is correct
-    if not os.access(filename, os.R_OK):
-        raise IOError("File {} can't be read\n".format(filename))
 
     logging.debug('Python scan for file: {}'.format(filename))
 
-    deps = set()
+    names = set()
 
     try:
+        if notebook is None:
+            if data is None:
+                data = read_file(filename)
+            notebook = load_notebook(data)
 
-        # https://nbformat.readthedocs.io/en/latest/api.html
-        ipynb = nbformat.read(filename, as_version=nbformat.NO_CONVERT)
-        # https://nbconvert.readthedocs.io/en/latest/nbconvert_library.html
-        python_exporter = PythonExporter()
-        (body, resources) = python_exporter.from_notebook_node(ipynb)
-
-        tree = ast.parse(body)
-
-        for node in ast.walk(tree):
-            modules = is_import(node)
-            if modules is not None:
-                for m in modules:
-                    if not is_python_std(m):
-                        orig = cleanup_import(m)
-                        tran = translate_python_import(orig)
-                        if tran != "ignore" and tran not in PY_LOCAL:
-                            deps.add(tran)
-                            logging.debug('Translating Python dependency {} into {}'.format(orig, tran))
-                        else:
-                            logging.debug('Ignoring Python dependency: {}'.format(orig))
+        names = get_jupyter_imports(notebook)
 
     except BaseException:
         logging.warning("Could not parse file: {}".format(filename))
 
-    return deps
+    return resolve_python_imports(names)
 
 
-def translate_r_library(name):
+def translate_r_library(name, r_deps=None):
     '''
        Auxiliary function to translate the module name
        into its conda package (e.g. library(qvalue) -> bioconductor-qvalue)
@@ -273,45 +852,89 @@ def translate_r_library(name):
        r_deps.json will be growing over time as
        we find more cases where the package name and the
        import name differs
+
+       Another translation table can be given in "r_deps"
     '''
 
-    result = R_DEPS.get(name, name)
+    if r_deps is None:
+        r_deps = R_DEPS
+
+    result = r_deps.get(name, name)
 
     return result
 
 
-def scan_r_imports(filename):
+def get_r_imports(source):
     '''
-       Auxiliary function to get R imports from a single file
+       Auxiliary function to get the names of the libraries
+       loaded in R source code, without any translation
     '''
-    # check input is correct
-    if not os.access(filename, os.R_OK):
-        raise IOError("File {} can't be read\n".format(filename))
 
-    logging.debug('R scan for file: {}'.format(filename))
+    results = re.findall(r"library\((\W*)([\w\.]+)(\W*)\)", source)
 
-    deps = set()
+    # the result of re.findall is a list of tuples where
+    # (match.group(0), match.group(1), match.group(2))
+    # and we are just interested in group(1)
+    return set(r[1] for r in results)
 
-    with open(filename) as f:
-        data = f.read()
 
-    results = re.findall(r"library\((\W*)([\w\.]+)(\W*)\)", data)
+def resolve_r_imports(names, r_deps=None):
+    '''
+       Auxiliary function to translate the names of
+       R libraries into conda packages, using the
+       translation table in "r_deps" if given
+    '''
 
-    for r in results:
-        # the result of re.findall is a list of tuples where
-        # (match.group(0), match.group(1), match.group(2))
-        # and we are just interested in group(1)
-        orig_library = r[1]
-        tran_library = translate_r_library(orig_library)
+    deps = set()
+
+    for orig_library in names:
+        tran_library = translate_r_library(orig_library, r_deps)
         if tran_library != "ignore":
-            deps.update([tran_library])
+            deps.add(tran_library)
             logging.debug('Translating R dependency {} into {}'.format(orig_library, tran_library))
         else:
             logging.debug('Ignoring R dependency: {}'.format(orig_library))
 
     return deps
 
-def scan_jupyter_magics(filename):
+
+def scan_r_imports(filename, data=None):
+    '''
+       Auxiliary function to get R imports from a single file.
+       The contents of the file can be given in "data" to avoid reading it
+    '''
+
+    logging.debug('R scan for file: {}'.format(filename))
+
+    if data is None:
+        data = read_file(filename)
+
+    return resolve_r_imports(get_r_imports(data))
+
+
+def scan_jupyter_r_imports(filename, data=None, notebook=None):
+    '''
+       Auxiliary function to get R imports from Jupyter notebooks.
+       Only the source of the code cells is scanned (e.g. %%R cells),
+       leaving out outputs like embedded images or HTML tables.
+
+       The contents of the file can be given in "data", or already
+       loaded in "notebook", to avoid reading it
+    '''
+
+    try:
+        if notebook is None:
+            if data is None:
+                data = read_file(filename)
+            notebook = load_notebook(data)
+    except ValueError:
+        logging.warning("Could not parse file: {}".format(filename))
+        return set()
+
+    return scan_r_imports(filename, '\n'.join(get_notebook_cells(notebook)))
+
+
+def scan_jupyter_magics(filename, data=None):
     '''
        Auxiliary function to scan Jupyter magics:
        https://ipython.readthedocs.io/en/stable/config/extensions/#extensions-bundled-with-ipython
@@ -319,29 +942,35 @@ def scan_jupyter_magics(filename):
        Warning: we are only interested in:
        * %load_ext rpy2.ipython
        * %load_ext Cython
+
+       The contents of the file can be given in "data" to avoid reading it
     '''
 
     deps = set()
 
-    filtered = ""
+    filtered = []
+
+    if data is None:
+        data = read_file(filename)
 
     # filter out lines with comments (#)
-    with open(filename) as f:
-        for l in f:
-            hash_pos = l.find('#')
-            load_pos = l.find('%')
-            if hash_pos != -1:
-                # there is a # in this line, need to check where
-                if hash_pos > load_pos:
-                    # means that we have something like: %load_ext bla # comment
-                    # therefore scan it
-                    filtered += l
-                # otherwise:
-                # means that we have something like: #%load_ext
-                # therefore, we filter this line
-            else:
-                # there is no # in this line, therefore scan it
-                filtered += l
+    for l in io.StringIO(data):
+        hash_pos = l.find('#')
+        load_pos = l.find('%')
+        if hash_pos != -1:
+            # there is a # in this line, need to check where
+            if hash_pos > load_pos:
+                # means that we have something like: %load_ext bla # comment
+                # therefore scan it
+                filtered.append(l)
+            # otherwise:
+            # means that we have something like: #%load_ext
+            # therefore, we filter this line
+        else:
+            # there is no # in this line, therefore scan it
+            filtered.append(l)
+
+    filtered = "".join(filtered)
 
     results = re.findall(r"%load_ext rpy2.ipython", filtered)
     if len(results) > 0:
@@ -354,108 +983,1160 @@ def scan_jupyter_magics(filename):
     return deps
 
 
-def check_deps(filename, exclude_folder):
+def glob_to_regex(pattern):
+    '''
+       Auxiliary function to translate a glob pattern into a regular
+       expression. Like in .gitignore files, "*" does not match "/"
+       while "**" matches any number of folders (e.g. **/tests/data)
+    '''
+
+    result = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith('**/', i):
+            result.append('(?:.*/)?')
+            i += 3
+        elif pattern.startswith('**', i):
+            result.append('.*')
+            i += 2
+        elif pattern[i] == '*':
+            result.append('[^/]*')
+            i += 1
+        elif pattern[i] == '?':
+            result.append('[^/]')
+            i += 1
+        elif pattern[i] == '[' and pattern.find(']', i + 2) != -1:
+            end = pattern.find(']', i + 2)
+            chars = pattern[i + 1:end].replace('\\', '\\\\')
+            if chars.startswith('!'):
+                chars = '^' + chars[1:]
+            result.append('[{}]'.format(chars))
+            i = end + 1
+        else:
+            result.append(re.escape(pattern[i]))
+            i += 1
+
+    return ''.join(result)
+
+
+class ExcludeMatcher:
+    '''
+       Folders to leave out of a scan, given either as paths or
+       as glob patterns. All patterns are compiled once:
+       * paths (e.g. /path/to/folder) go into a set of absolute paths
+       * patterns without "/" (e.g. *.egg-info) match folder names
+       * other patterns (e.g. **/tests/data) match the path of the
+         folder, relative to the folder being scanned unless absolute
+    '''
+
+    def __init__(self, patterns=(), base=None):
+        self.paths = set()
+        self.patterns = {'names': [], 'absolute': [], 'relative': []}
+        self.add(patterns, base)
+
+    def add(self, patterns, base=None, names=False):
+        '''
+           Add more patterns. Relative paths are taken from "base"
+           (default: current folder). When "names" is set, all the
+           patterns match folder names, even those without wildcards
+        '''
+
+        if base is None:
+            base = os.getcwd()
+
+        for p in patterns:
+            p = p.replace(os.sep, '/').rstrip('/')
+            if not p:
+                continue
+            if names:
+                self.patterns['names'].append(glob_to_regex(p))
+            elif not GLOB_CHARS.search(p):
+                self.paths.add(os.path.abspath(os.path.join(base, p)))
+            elif '/' not in p:
+                self.patterns['names'].append(glob_to_regex(p))
+            elif os.path.isabs(p):
+                self.patterns['absolute'].append(glob_to_regex(p))
+            else:
+                self.patterns['relative'].append(glob_to_regex(p))
+
+        self.names = self.compile(self.patterns['names'])
+        self.absolute = self.compile(self.patterns['absolute'])
+        self.relative = self.compile(self.patterns['relative'])
+
+    def copy(self):
+        '''
+           Return a copy that can be extended independently
+        '''
+
+        result = ExcludeMatcher()
+        result.paths = set(self.paths)
+        result.patterns = {k: list(v) for (k, v) in self.patterns.items()}
+        result.add([])
+        return result
+
+    @staticmethod
+    def compile(patterns):
+        if not patterns:
+            return None
+        return re.compile('|'.join('(?:{})'.format(p) for p in patterns))
+
+    def __bool__(self):
+        return bool(self.paths) or self.names is not None or \
+            self.absolute is not None or self.relative is not None
+
+    def match(self, path, root):
+        '''
+           Test whether a folder inside "root" has to be excluded
+        '''
+
+        if self.names is not None and \
+                self.names.fullmatch(os.path.basename(path)):
+            return True
+        full_path = os.path.abspath(path)
+        if full_path in self.paths:
+            return True
+        full_path = full_path.replace(os.sep, '/')
+        if self.absolute is not None and self.absolute.fullmatch(full_path):
+            return True
+        if self.relative is not None:
+            relative_path = os.path.relpath(path, root).replace(os.sep, '/')
+            if self.relative.fullmatch(relative_path):
+                return True
+        return False
+
+
+def read_ignore_file(folder):
+    '''
+       Auxiliary function to read the patterns in the .condadepsignore
+       file of a folder, if any. It has one path or glob pattern per
+       line, with the same syntax as --exclude-folder. Relative paths
+       are taken from the folder. Empty lines and comments (#) are ignored
+    '''
+
+    filename = os.path.join(folder, IGNORE_FILE)
+    if not os.path.isfile(filename):
+        return []
+
+    logging.debug('Reading exclusions from {}'.format(filename))
+    with open(filename) as f:
+        return parse_ignore_file(f)
+
+
+def parse_ignore_file(lines):
+    '''
+       Auxiliary function to get the patterns from the
+       lines of a .condadepsignore file
+    '''
+
+    result = []
+
+    for l in lines:
+        l = l.strip()
+        if l and not l.startswith('#'):
+            result.append(l)
+
+    return result
+
+
+def is_archive(filename):
+    '''
+       Auxiliary function to test whether a file is an archive
+       (e.g. a source distribution or a wheel) to scan
+    '''
+
+    return os.path.isfile(filename) and filename.endswith(ARCHIVE_EXTENSIONS)
+
+
+def check_no_archives(filenames, mode):
+    '''
+       Auxiliary function to stop scans that only read files
+       and folders from being given archives, which they
+       would leave out instead of scanning them
+    '''
+
+    for f in filenames:
+        if is_archive(f):
+            raise IOError("Archives can not be used with {}: {}\n".format(mode, f))
+
+
+def is_environment(dirs, files):
+    '''
+       Auxiliary function to detect whether a folder
+       holds a conda environment or a Python virtualenv
+    '''
+
+    return 'conda-meta' in dirs or 'pyvenv.cfg' in files
+
+
+def collect_files(filename, exclude_folder, default_excludes=True,
+                  follow_symlinks=False):
     '''
        Auxiliary function to detect whether input is a file or a folder
-       and operate accordingly
+       and get the list of files to scan accordingly.
+
+       Folders to leave out are given in "exclude_folder", either as
+       an ExcludeMatcher or as a list of paths and glob patterns.
+       Patterns from the .condadepsignore file in the folder are
+       added to them. Unless "default_excludes" is unset, folders
+       that never have source code (e.g. .git, __pycache__, conda
+       environments) are left out as well.
+
+       Symbolic links to folders are only followed when "follow_symlinks"
+       is set. Then each folder and file is visited only once, however
+       many links, hard links or bind mounts lead to it, which also
+       stops links to a parent folder from looping forever
     '''
 
+    if not isinstance(exclude_folder, ExcludeMatcher):
+        exclude_folder = ExcludeMatcher(exclude_folder)
+
     # check input is correct
     if not os.access(filename, os.R_OK):
         raise IOError("File {} can't be read\n".format(filename))
 
     # list of files to scan
-    scan_python = []
-    scan_r = []
-    scan_jupyter = []
-    jupyter_magics = []
+    scan_files = []
 
     if os.path.isdir(filename):
         # scan all python files in the folder
-        for dirpath, dirs, files in os.walk(filename):
-            for d in dirs.copy():
-                full_dir = os.path.abspath(os.path.join(dirpath, d))
-                if full_dir in exclude_folder:
-                    dirs.remove(d)
-                    logging.debug("not going down {}".format(full_dir))
-            for f in files:
-                if f.endswith(".py"):
-                    scan_python.append(os.path.join(dirpath, f))
-                    scan_r.append(os.path.join(dirpath, f))
-                elif f.endswith(".R") or f.endswith(".Rmd"):
-                    scan_r.append(os.path.join(dirpath, f))
-                elif f.endswith(".ipynb"):
-                    scan_jupyter.append(os.path.join(dirpath, f))
-                    jupyter_magics.append(os.path.join(dirpath, f))
-                    scan_r.append(os.path.join(dirpath, f))
+        for (dirpath, files) in walk_folder(filename, exclude_folder,
+                                            default_excludes, follow_symlinks):
+            scan_files.extend(files)
     else:
         # case of single file
-        if filename.endswith(".py"):
-            scan_python.append(filename)
-            scan_r.append(filename)
-        elif filename.endswith(".R") or filename.endswith(".Rmd"):
-            scan_r.append(filename)
-        elif filename.endswith(".ipynb"):
-            scan_jupyter.append(filename)
-            jupyter_magics.append(filename)
-            scan_r.append(filename)
+        if filename.endswith(SCAN_EXTENSIONS):
+            scan_files.append(filename)
         else:
             logging.warning("Unrecognized file format. Expected files ending in: .py, .ipynb, .R, and .Rmd".format(filename))
 
-    # set of dependencies
-    python_deps = set()
-    r_deps = set()
+    return scan_files
+
+
+def get_inode(path):
+    '''
+       Auxiliary function to identify the file or folder a path
+       leads to (following symbolic links), or to get None if
+       it can not be read
+    '''
+
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return st.st_dev, st.st_ino
+
+
+def walk_folder(folder, exclude_folder, default_excludes=True,
+                follow_symlinks=False):
+    '''
+       Auxiliary function to walk a folder leaving out excluded
+       folders, as explained in collect_files. Yields a tuple
+       (folder, files to scan) for each folder visited
+    '''
+
+    if not isinstance(exclude_folder, ExcludeMatcher):
+        exclude_folder = ExcludeMatcher(exclude_folder)
+
+    exclude_folder = exclude_folder.copy()
+    if default_excludes:
+        exclude_folder.add(DEFAULT_EXCLUDES, names=True)
+    exclude_folder.add(read_ignore_file(folder), base=folder)
+
+    # (device, inode) of the folders and files visited
+    # when following symbolic links
+    visited = {get_inode(folder)}
+
+    for dirpath, dirs, files in os.walk(folder, followlinks=follow_symlinks):
+        if default_excludes and dirpath != folder and \
+                is_environment(dirs, files):
+            dirs.clear()
+            logging.debug("not going down environment {}".format(dirpath))
+            continue
+        if exclude_folder:
+            for d in dirs.copy():
+                full_dir = os.path.join(dirpath, d)
+                if exclude_folder.match(full_dir, folder):
+                    dirs.remove(d)
+                    logging.debug("not going down {}".format(full_dir))
+        scan_files = [os.path.join(dirpath, f) for f in files
+                      if f.endswith(SCAN_EXTENSIONS)]
+        if follow_symlinks:
+            for d in dirs.copy():
+                full_dir = os.path.join(dirpath, d)
+                inode = get_inode(full_dir)
+                if inode is None or inode in visited:
+                    dirs.remove(d)
+                    logging.debug("not going down {} again".format(full_dir))
+                else:
+                    visited.add(inode)
+            unique_files = []
+            for f in scan_files:
+                inode = get_inode(f)
+                if inode is not None and inode in visited:
+                    logging.debug("not scanning {} again".format(f))
+                    continue
+                visited.add(inode)
+                unique_files.append(f)
+            scan_files = unique_files
+        yield dirpath, scan_files
+
+
+def get_folder_filter(folder, exclude_folder, default_excludes=True,
+                      ignore_patterns=(), environments=()):
+    '''
+       Auxiliary function to get a function that tells whether a
+       folder, given relative to "folder" (using "/" as separator),
+       is excluded as explained in collect_files, given the patterns
+       of the .condadepsignore file and the paths of the conda
+       environments and virtualenvs inside the folder
+    '''
+
+    if not isinstance(exclude_folder, ExcludeMatcher):
+        exclude_folder = ExcludeMatcher(exclude_folder)
+
+    exclude_folder = exclude_folder.copy()
+    if default_excludes:
+        exclude_folder.add(DEFAULT_EXCLUDES, names=True)
+    exclude_folder.add(ignore_patterns, base=folder)
+
+    # whether each folder is excluded, as many files share them
+    excluded = {'': False}
+
+    def is_excluded(d):
+        if d not in excluded:
+            excluded[d] = is_excluded(d.rpartition('/')[0]) or \
+                d in environments or \
+                exclude_folder.match(os.path.join(folder, d), folder)
+            if excluded[d]:
+                logging.debug("not going down {}".format(os.path.join(folder, d)))
+        return excluded[d]
+
+    return is_excluded
+
+
+def filter_files(folder, paths, exclude_folder, default_excludes=True,
+                 ignore_patterns=None):
+    '''
+       Auxiliary function to get the files to scan from a list of
+       paths relative to "folder" (using "/" as separator), e.g. the
+       files in a git repository, applying the same exclusions as
+       collect_files.
+
+       The patterns in the .condadepsignore file are read from the
+       folder, unless they are given in "ignore_patterns"
+    '''
+
+    if ignore_patterns is None:
+        ignore_patterns = read_ignore_file(folder)
+
+    # conda environments and virtualenvs inside the folder
+    environments = set()
+    if default_excludes:
+        for p in paths:
+            parts = p.split('/')
+            if 'conda-meta' in parts[1:-1]:
+                environments.add('/'.join(parts[:parts.index('conda-meta', 1)]))
+            elif parts[-1] == 'pyvenv.cfg' and len(parts) > 1:
+                environments.add('/'.join(parts[:-1]))
+
+    is_excluded = get_folder_filter(folder, exclude_folder, default_excludes,
+                                    ignore_patterns, environments)
+
+    return [p for p in paths
+            if p.endswith(SCAN_EXTENSIONS) and
+            not is_excluded(p.rpartition('/')[0])]
+
+
+def check_deps(filename, exclude_folder, jobs=1, cache=None):
+    '''
+       Auxiliary function to detect whether input is a file or a folder
+       and operate accordingly
+    '''
+
+    return scan_all_files(collect_files(filename, exclude_folder), jobs, cache)
+
+
+def iter_deps(filename, exclude_folder=(), jobs=1, cache=None):
+    '''
+       Auxiliary function to scan a file or folder like check_deps,
+       yielding a ScanRecord for each file as soon as it is done
+    '''
+
+    return Scanner(exclude_folder, jobs=jobs, cache=cache).iter_scan(filename)
+
+
+def get_language(filename):
+    '''
+       Auxiliary function to get the language of
+       a file to scan from its extension
+    '''
+
+    if filename.endswith(".py"):
+        return 'python'
+    elif filename.endswith(".R"):
+        return 'r'
+    elif filename.endswith(".Rmd"):
+        return 'rmarkdown'
+    elif filename.endswith(".ipynb"):
+        return 'jupyter'
+    return None
+
+
+def extract_file(filename, with_digest=False, profile=None, seen=None):
+    '''
+       Auxiliary function to run all the scanners that apply
+       to a single file, depending on its extension.
+
+       The file is read only once and its contents are handed to
+       every scanner. The result is a dictionary with the raw names
+       found, before any translation:
+       * python: modules imported in Python code
+       * r: libraries loaded in R code
+       * magics: conda packages required by Jupyter magics
+
+       When "with_digest" is set, a hash of the contents
+       is returned as well, otherwise None.
+
+       When a dictionary is given in "seen", the results are kept
+       there by hash of the contents, and files with the same contents
+       as one scanned before are not parsed again
+    '''
+
+    if profile is None:
+        profile = NO_PROFILE
+
+    # check input is correct
+    if not os.access(filename, os.R_OK):
+        raise IOError("File {} can't be read\n".format(filename))
+
+    with profile.phase('read'):
+        with open(filename, 'rb') as f:
+            raw = f.read()
+
+    return extract_data(filename, raw, with_digest, profile, seen)
+
+
+def extract_data(filename, raw, with_digest=False, profile=None, seen=None):
+    '''
+       Auxiliary function to run all the scanners that apply to
+       the contents of a file given as bytes in "raw" (e.g. read
+       from a git object), depending on the extension of "filename".
+       See extract_file for the result and "seen"
+    '''
 
-    # scan all files
-    for f in scan_python:
-        python_deps.update(scan_python_imports(f))
+    if profile is None:
+        profile = NO_PROFILE
+
+    python_imports = set()
+    r_imports = set()
+    magics = set()
+
+    with profile.phase('read'):
+        digest = None
+        if with_digest or seen is not None:
+            digest = hashlib.blake2b(raw, digest_size=20).hexdigest()
+    if profile.enabled:
+        profile.files['read'] += 1
+        profile.bytes['read'] += len(raw)
+
+    if seen is not None:
+        # the same contents are scanned differently depending on the language
+        key = (digest, get_language(filename))
+        if key in seen:
+            logging.debug('Same contents as a file scanned before: {}'.format(filename))
+            if profile.enabled:
+                profile.files['duplicate'] += 1
+            return seen[key], digest
+
+    with profile.phase('read'):
+        try:
+            data = decode_file(raw)
+        except UnicodeDecodeError:
+            logging.warning("Could not parse file: {}".format(filename))
+            data = None
+
+    if data is None:
+        pass
+    elif filename.endswith(".py"):
+        logging.debug('Python scan for file: {}'.format(filename))
+        with profile.phase('python', len(raw)):
+            try:
+                python_imports = get_python_imports(data)
+            except BaseException:
+                logging.warning("Could not parse file: {}".format(filename))
+        logging.debug('R scan for file: {}'.format(filename))
+        with profile.phase('r', len(raw)):
+            r_imports = get_r_imports(data)
+    elif filename.endswith(".R") or filename.endswith(".Rmd"):
+        logging.debug('R scan for file: {}'.format(filename))
+        with profile.phase('r', len(raw)):
+            r_imports = get_r_imports(data)
+    elif filename.endswith(".ipynb"):
+        logging.debug('Python scan for file: {}'.format(filename))
+        notebook = None
+        with profile.phase('jupyter', len(raw)):
+            try:
+                notebook = load_notebook(data)
+            except BaseException:
+                logging.warning("Could not parse file: {}".format(filename))
+            # code cells are not Python in notebooks with other
+            # kernels (e.g. R), which must not stop the R scan
+            if notebook is not None:
+                try:
+                    python_imports = get_jupyter_imports(notebook)
+                except BaseException:
+                    logging.warning("Could not parse file: {}".format(filename))
+        if notebook is not None:
+            logging.debug('R scan for file: {}'.format(filename))
+            code = '\n'.join(get_notebook_cells(notebook))
+            with profile.phase('r', len(code)):
+                try:
+                    r_imports = get_r_imports(code)
+                except BaseException:
+                    logging.warning("Could not parse file: {}".format(filename))
+        with profile.phase('magics', len(raw)):
+            magics = scan_jupyter_magics(filename, data)
+
+    result = {'python': sorted(python_imports),
+              'r': sorted(r_imports),
+              'magics': sorted(magics)}
+
+    if seen is not None:
+        seen[key] = result
+
+    return result, digest
+
+
+def extract_data_profiled(filename, raw, with_digest=False):
+    '''
+       Auxiliary function to run extract_data in a worker process
+       and send the timings back to the main process
+    '''
 
-    for f in scan_r:
-        r_deps.update(scan_r_imports(f))
+    profile = Profile()
+    (result, digest) = extract_data(filename, raw, with_digest, profile)
+    return result, digest, profile
 
-    for f in scan_jupyter:
-        python_deps.update(scan_jupyter_imports(f))
 
-    for f in jupyter_magics:
-        python_deps.update(scan_jupyter_magics(f))
+def extract_all_data(contents, executor=None, window=4, profile=None):
+    '''
+       Auxiliary function to run the scanners on contents that are
+       not read from files on disk (e.g. git objects or members of
+       an archive), given as tuples (key, filename, bytes). They
+       are scanned in this process or with "executor", with at most
+       "window" contents waiting for a worker, so memory does not
+       grow with the number of files. Yields a tuple (key, result)
+       for each one, in the same order.
+
+       Contents identical to earlier ones are not parsed again
+    '''
+
+    if profile is None:
+        profile = NO_PROFILE
+
+    seen = ContentMemo()
+
+    if executor is None:
+        for (key, filename, raw) in contents:
+            (result, digest) = extract_data(filename, raw, False, profile, seen)
+            yield key, result
+        return
+
+    if profile.enabled:
+        extract = extract_data_profiled
+    else:
+        extract = extract_data
+
+    def collect(key, future, duplicate):
+        r = future.result()
+        if profile.enabled and not duplicate:
+            profile.update(r[2])
+        return key, r[0]
+
+    running = collections.deque()
+    for (key, filename, raw) in contents:
+        # the same contents are scanned differently depending on the language
+        digest = (hashlib.blake2b(raw, digest_size=20).digest(), get_language(filename))
+        future = seen.get(digest)
+        if future is not None:
+            logging.debug('Same contents as a file scanned before: {}'.format(filename))
+            if profile.enabled:
+                profile.files['duplicate'] += 1
+            running.append((key, future, True))
+        else:
+            future = executor.submit(extract, filename, raw)
+            seen[digest] = future
+            running.append((key, future, False))
+        while len(running) > window:
+            yield collect(*running.popleft())
+    while running:
+        yield collect(*running.popleft())
+
+
+def resolve_deps(python_imports, r_imports, magics, py_deps=None,
+                 r_deps=None, local_modules=None):
+    '''
+       Auxiliary function to translate all the raw names found
+       in the scanned files into conda packages. Each name
+       is only resolved once. See resolve_python_imports and
+       resolve_r_imports for the rest of the arguments
+    '''
+
+    python_deps = resolve_python_imports(python_imports, py_deps, local_modules)
+    python_deps.update(magics)
+    r_deps = resolve_r_imports(r_imports, r_deps)
 
     return python_deps, r_deps
 
 
+def init_worker(debug):
+    '''
+       Auxiliary function to set up a worker process
+       before it starts scanning files
+    '''
+
+    # forked workers inherit the handlers of the parent process
+    if not logging.getLogger().handlers:
+        config_logging(debug)
+
+
+def extract_files(filenames, with_digest=False, profiled=False):
+    '''
+       Auxiliary function to run extract_file on a chunk of files in
+       a worker process. Returns a list of tuples (result, digest,
+       seconds spent) for each file and, when "profiled" is set, the
+       timings of all of them (None otherwise). Files with the same
+       contents as another one in the chunk are not parsed again
+    '''
+
+    profile = Profile(enabled=profiled)
+    results = []
+    seen = {}
+    for f in filenames:
+        start = time.perf_counter()
+        (result, digest) = extract_file(f, with_digest, profile, seen)
+        results.append((result, digest, time.perf_counter() - start))
+    return results, profile if profiled else None
+
+
+def get_file_size(filename, st=None):
+    '''
+       Auxiliary function to get the size of a file from its
+       stats if given, or 0 if it can not be read
+    '''
+
+    if st is not None:
+        return st.st_size
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return 0
+
+
+def lookup_cache(cache, filename, blob=None):
+    '''
+       Auxiliary function to look up a file in the cache, by its
+       git object ID if given in "blob" or by its stats otherwise.
+       Returns the stats of the file, the cache key of the object
+       and the cached result, or None if there is no valid entry
+    '''
+
+    st = None
+    cached = None
+    if blob is not None:
+        # the contents of a file with the same object ID
+        # are scanned differently depending on its language
+        blob = '{}:{}'.format(blob, get_language(filename))
+        cached = cache.get_blob(blob)
+    else:
+        try:
+            st = os.stat(filename)
+        except OSError:
+            pass
+        if st is not None:
+            cached = cache.get(filename, st)
+    return st, blob, cached
+
+
+def store_cache(cache, filename, st, blob, result, digest):
+    '''
+       Auxiliary function to store the result of a file in
+       the cache, with the stats and key from lookup_cache
+    '''
+
+    if blob is not None:
+        cache.put_blob(blob, result)
+    elif st is not None:
+        cache.put(filename, st, result, digest)
+
+
+def extract_all_files_timed(scan_files, jobs=1, cache=None, profile=None, blobs=None):
+    '''
+       Auxiliary function to extract the raw names from a list of
+       files, either one after another or with a pool of "jobs"
+       worker processes. Files with a valid entry in the cache are
+       not scanned again. Yields a tuple (filename, result, seconds
+       spent) for each file as soon as it is done, in no particular
+       order. Only a bounded number of files are handed to the
+       workers at a time, so memory does not grow with the number
+       of files.
+
+       Files with the same contents as another one are not parsed
+       again. Worker processes only compare the files in the chunks
+       they are sent, so files are sorted by size first to send
+       identical files together.
+
+       When the git object IDs of the files are known, they can be
+       given in "blobs" (a dictionary from file name to object ID)
+       and they are used as cache keys instead of the file stats.
+    '''
+
+    if profile is None:
+        profile = NO_PROFILE
+
+    if blobs is None:
+        blobs = {}
+
+    # look up the files in the cache first
+    pending = []
+    if cache is None:
+        pending = [(f, None, None) for f in scan_files]
+    else:
+        for f in scan_files:
+            start = time.perf_counter()
+            with profile.phase('cache'):
+                (st, blob, cached) = lookup_cache(cache, f, blobs.get(f))
+            if cached is not None:
+                if profile.enabled:
+                    profile.files['cache'] += 1
+                yield f, cached, time.perf_counter() - start
+            else:
+                pending.append((f, st, blob))
+
+    with_digest = cache is not None
+
+    with profile.phase('scan'):
+        if jobs > 1 and len(pending) > 1:
+            jobs = min(jobs, len(pending))
+            # larger files first, so workers are not left
+            # waiting for a large file at the end
+            pending.sort(key=lambda entry: get_file_size(entry[0], entry[1]),
+                         reverse=True)
+            # send files in chunks to keep the overhead of
+            # inter-process communication low
+            chunksize = max(1, min(len(pending) // (jobs * 4), 256))
+            chunks = [pending[k:k + chunksize]
+                      for k in range(0, len(pending), chunksize)]
+            debug = logging.getLogger().isEnabledFor(logging.DEBUG)
+            with concurrent.futures.ProcessPoolExecutor(
+                    max_workers=jobs,
+                    initializer=init_worker,
+                    initargs=(debug,)) as executor:
+                running = {}
+
+                def collect():
+                    (done, _) = concurrent.futures.wait(
+                        running, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        chunk = running.pop(future)
+                        (results, worker_profile) = future.result()
+                        if worker_profile is not None:
+                            profile.update(worker_profile)
+                        for ((f, st, blob), (result, digest, seconds)) in \
+                                zip(chunk, results):
+                            if cache is not None:
+                                store_cache(cache, f, st, blob, result, digest)
+                            yield f, result, seconds
+
+                try:
+                    for chunk in chunks:
+                        # keep a couple of chunks waiting for each worker
+                        if len(running) >= jobs * 2:
+                            yield from collect()
+                        future = executor.submit(extract_files,
+                                                 [f for (f, st, blob) in chunk],
+                                                 with_digest, profile.enabled)
+                        running[future] = chunk
+                    while running:
+                        yield from collect()
+                finally:
+                    # when the caller stops early
+                    for future in running:
+                        future.cancel()
+        else:
+            seen = ContentMemo()
+            for (f, st, blob) in pending:
+                start = time.perf_counter()
+                (result, digest) = extract_file(f, with_digest, profile, seen)
+                if cache is not None:
+                    store_cache(cache, f, st, blob, result, digest)
+                yield f, result, time.perf_counter() - start
+    if profile.enabled:
+        profile.files['scan'] += len(pending)
+
+
+def extract_all_files(scan_files, jobs=1, cache=None, profile=None, blobs=None):
+    '''
+       Auxiliary function to extract the raw names from a list of files.
+       Yields a tuple (filename, result) for each file, in no particular
+       order. See extract_all_files_timed for the arguments
+    '''
+
+    for (f, result, seconds) in extract_all_files_timed(scan_files, jobs, cache,
+                                                        profile, blobs):
+        yield f, result
+
+
+def merge_results(results):
+    '''
+       Auxiliary function to get the unique raw names found in the
+       results of many files. Returns the Python imports, the R
+       imports and the conda packages required by Jupyter magics
+    '''
+
+    python_imports = set()
+    r_imports = set()
+    magics = set()
+
+    for result in results:
+        python_imports.update(result['python'])
+        r_imports.update(result['r'])
+        magics.update(result['magics'])
+
+    return python_imports, r_imports, magics
+
+
+def scan_all_files(scan_files, jobs=1, cache=None, profile=None, blobs=None):
+    '''
+       Auxiliary function to scan a list of files, either one
+       after another or with a pool of "jobs" worker processes.
+       See extract_all_files for the rest of the arguments.
+
+       Scanning happens in two phases: first the raw names are
+       extracted from each file, then the unique names found in
+       all files are translated into conda packages
+    '''
+
+    if profile is None:
+        profile = NO_PROFILE
+
+    results = extract_all_files(scan_files, jobs, cache, profile, blobs)
+    (python_imports, r_imports, magics) = merge_results(r for (f, r) in results)
+
+    with profile.phase('resolve'):
+        return resolve_deps(python_imports, r_imports, magics)
+
+
+# result of scanning a single file, yielded by Scanner.iter_scan:
+# * path: the path of the file
+# * language: python, r, rmarkdown or jupyter
+# * raw_imports: the names found by the scanners (see extract_file)
+# * resolved_deps: the Python and R conda packages for those names
+# * elapsed: seconds spent scanning the file (or looking it up in the cache)
+ScanRecord = collections.namedtuple(
+    'ScanRecord', ['path', 'language', 'raw_imports', 'resolved_deps', 'elapsed'])
+
+
+class Scanner:
+    '''
+       Scans files, folders, archives and git repositories for
+       dependencies. A scanner owns its translation tables, the
+       local modules of the last folder scanned, the folders to
+       exclude and the cache, so several scanners can be used in
+       the same process without interfering with each other, and
+       each one can be reused for many scans.
+
+       The translation tables start as copies of the default ones,
+       unless others are given in "py_deps" and "r_deps". See
+       collect_files for "exclude_folder", "default_excludes" and
+       "follow_symlinks", and extract_all_files for "jobs", "cache"
+       and "profile"
+    '''
+
+    def __init__(self, exclude_folder=(), default_excludes=True, jobs=1,
+                 cache=None, profile=None, py_deps=None, r_deps=None,
+                 follow_symlinks=False):
+        if not isinstance(exclude_folder, ExcludeMatcher):
+            exclude_folder = ExcludeMatcher(exclude_folder)
+        if profile is None:
+            profile = NO_PROFILE
+
+        self.exclude_folder = exclude_folder
+        self.default_excludes = default_excludes
+        self.follow_symlinks = follow_symlinks
+        self.jobs = jobs
+        self.cache = cache
+        self.profile = profile
+        self.py_deps = dict(PY_DEPS if py_deps is None else py_deps)
+        self.r_deps = dict(R_DEPS if r_deps is None else r_deps)
+        self.local_modules = set()
+
+    def add_py_translations(self, filename):
+        '''
+           Add project specific translations for Python from a json file
+        '''
+
+        with open(filename) as f:
+            self.py_deps.update(json.load(f))
+
+    def add_r_translations(self, filename):
+        '''
+           Add project specific translations for R from a json file
+        '''
+
+        with open(filename) as f:
+            self.r_deps.update(json.load(f))
+
+    def resolve(self, python_imports, r_imports, magics):
+        '''
+           Translate raw names into conda packages, as resolve_deps
+        '''
+
+        with self.profile.phase('resolve'):
+            return resolve_deps(python_imports, r_imports, magics,
+                                self.py_deps, self.r_deps, self.local_modules)
+
+    def collect(self, filename, git=False):
+        '''
+           Get the files to scan in a file or folder, either walking
+           it or, when "git" is set, from the git index. Returns the
+           files and a dictionary with the git object IDs of the
+           files taken from the git index
+        '''
+
+        if git:
+            from . import gitscan
+            if gitscan.is_git_repository(filename):
+                return gitscan.collect_git_files(filename, self.exclude_folder,
+                                                 self.default_excludes)
+            elif os.path.isdir(filename):
+                logging.warning("{} is not a git repository, walking it instead".format(filename))
+        return collect_files(filename, self.exclude_folder,
+                             self.default_excludes, self.follow_symlinks), {}
+
+    def collect_all(self, filename, include_files=(), git=False):
+        '''
+           Get the files to scan in a file or folder and in additional
+           files or folders in "include_files", working out the local
+           modules from the first one. Returns the files, their git
+           object IDs (see collect) and the archives to scan
+        '''
+
+        # archives are scanned while they are read
+        archives = [f for f in [filename] + list(include_files)
+                    if is_archive(f)]
+
+        # walk the folder only once to get both the files to scan
+        # and the Python files located inside the folder
+        with self.profile.phase('walk'):
+            scan_files = []
+            blobs = {}
+            self.local_modules = set()
+            if not is_archive(filename):
+                (scan_files, blobs) = self.collect(filename, git)
+                self.local_modules = get_local_imports(filename, scan_files)
+
+            # scan additional files
+            for f in include_files:
+                if not is_archive(f):
+                    (files, found) = self.collect(f, git)
+                    scan_files.extend(files)
+                    blobs.update(found)
+        if self.profile.enabled:
+            self.profile.files['walk'] += len(scan_files)
+
+        return scan_files, blobs, archives
+
+    def scan_archives(self, filename, archives, local_modules):
+        '''
+           Scan archives, adding the local modules of the one in
+           "filename" if any to the set "local_modules". Yields a
+           tuple (path, result) for each file in the archives
+        '''
+
+        if not archives:
+            return
+
+        from . import archive
+        for f in archives:
+            (found, modules) = archive.scan_archive(
+                f, self.exclude_folder, self.default_excludes,
+                self.jobs, self.profile)
+            if f == filename:
+                local_modules.update(modules)
+            yield from found
+
+    def scan(self, filename, include_files=(), git=False):
+        '''
+           Scan a file, folder or archive, together with additional
+           files, folders or archives in "include_files". Local modules
+           are worked out from the first one. Returns the Python and
+           R dependencies
+        '''
+
+        (scan_files, blobs, archives) = self.collect_all(filename, include_files, git)
+
+        archive_results = list(self.scan_archives(filename, archives,
+                                                  self.local_modules))
+        results = extract_all_files(scan_files, self.jobs, self.cache,
+                                    self.profile, blobs)
+        (python_imports, r_imports, magics) = merge_results(
+            r for (f, r) in itertools.chain(archive_results, results))
+
+        return self.resolve(python_imports, r_imports, magics)
+
+    def iter_scan(self, filename, include_files=(), git=False):
+        '''
+           Scan the same files as scan, yielding a ScanRecord for each
+           file as soon as it is done, in no particular order, instead
+           of the dependencies of all of them. Results are not kept,
+           so memory does not grow with the number of files, and the
+           scan stops when the caller stops iterating.
+
+           The time spent is 0 for files in archives, which are
+           only yielded once the whole archive has been read
+        '''
+
+        (scan_files, blobs, archives) = self.collect_all(filename, include_files, git)
+        # other scans may replace the local modules of the scanner
+        # while the records of this one are being yielded
+        local_modules = self.local_modules
+
+        def record(f, result, seconds):
+            deps = resolve_deps(result['python'], result['r'], result['magics'],
+                                self.py_deps, self.r_deps, local_modules)
+            return ScanRecord(f, get_language(f), result, deps, seconds)
+
+        for (f, result) in self.scan_archives(filename, archives, local_modules):
+            yield record(f, result, 0.0)
+
+        for (f, result, seconds) in extract_all_files_timed(
+                scan_files, self.jobs, self.cache, self.profile, blobs):
+            yield record(f, result, seconds)
+
+    def scan_rev(self, folder, rev, include_files=()):
+        '''
+           Scan the files in the commit "rev" of a git repository
+           without checking it out, together with additional files
+           or folders from the file system in "include_files".
+           Returns the Python and R dependencies
+        '''
+
+        from . import gitscan
+        if not os.path.isdir(folder) or not gitscan.is_git_repository(folder):
+            raise IOError("{} is not a git repository\n".format(folder))
+        check_no_archives(include_files, 'a commit')
+
+        with self.profile.phase('walk'):
+            try:
+                rev_files = gitscan.collect_rev_files(
+                    folder, rev, self.exclude_folder, self.default_excludes)
+            except subprocess.CalledProcessError as e:
+                raise IOError("Could not read {} from {}: {}\n".format(
+                    rev, folder, e.stderr.decode(errors='replace').strip()))
+            self.local_modules = get_local_imports(
+                folder, [os.path.join(folder, p) for p in rev_files])
+
+            # additional files are scanned from the work tree
+            scan_files = []
+            for f in include_files:
+                scan_files.extend(self.collect(f)[0])
+        if self.profile.enabled:
+            self.profile.files['walk'] += len(rev_files) + len(scan_files)
+
+        results = itertools.chain(
+            gitscan.extract_rev_files(folder, rev_files, self.jobs,
+                                      self.cache, self.profile),
+            extract_all_files(scan_files, self.jobs, self.cache, self.profile))
+        (python_imports, r_imports, magics) = merge_results(r for (f, r) in results)
+
+        return self.resolve(python_imports, r_imports, magics)
+
+    def scan_history(self, folder, revisions):
+        '''
+           Get the dependencies in each commit of a range of a git
+           repository. Yields a tuple (commit, Python dependencies,
+           R dependencies) for the commit before the range and then
+           for each commit, see gitscan.scan_history
+        '''
+
+        from . import gitscan
+        if not os.path.isdir(folder) or not gitscan.is_git_repository(folder):
+            raise IOError("{} is not a git repository\n".format(folder))
+
+        try:
+            yield from gitscan.scan_history(self, folder, revisions)
+        except subprocess.CalledProcessError as e:
+            raise IOError("Could not read {} from {}: {}\n".format(
+                revisions, folder, e.stderr.decode(errors='replace').strip()))
+
+    def scan_incremental(self, output, roots, git=False, since=None):
+        '''
+           Scan the files or folders in "roots" reusing the results
+           kept next to the environment file "output".
+           See incremental.scan_incremental
+        '''
+
+        from . import incremental
+        check_no_archives(roots, 'incremental scans')
+        return incremental.scan_incremental(self, output, roots, git, since)
+
+    def watch(self, roots, output):
+        '''
+           Scan the files or folders in "roots" and keep the
+           environment file "output" up to date until interrupted.
+           See watch.watch
+        '''
+
+        from . import watch
+        check_no_archives(roots, 'watched files')
+        watch.watch(self, roots, output)
+
+    def close(self):
+        '''
+           Write pending entries of the cache
+        '''
+
+        if self.cache is not None:
+            self.cache.close()
+
+
 def print_conda_env(python_deps, r_deps, envname="myenv",
-                    envchannels=["conda-forge", "bioconda", "defaults"]):
+                    envchannels=["conda-forge", "bioconda", "defaults"],
+                    output=None):
     '''
-       Print conda environment file
+       Print conda environment file, to "output" if given
+       or to the standard output otherwise
     '''
 
     if len(python_deps) == 0 and len(r_deps) == 0:
-        print("\nNo dependencies found.\n")
+        print("\nNo dependencies found.\n", file=output)
         return
 
-    print("\nname: {}".format(envname))
+    print("\nname: {}".format(envname), file=output)
 
-    print("\nchannels:")
+    print("\nchannels:", file=output)
     for c in envchannels:
-        print(" - {}".format(c))
-    print("\ndependencies:")
+        print(" - {}".format(c), file=output)
+    print("\ndependencies:", file=output)
     first = True
     for d in sorted(python_deps):
         # make sure Python is listed as a dependency
         if first:
-            print(" - python")
+            print(" - python", file=output)
             first = False
         # add sanity check for suspicious dependencies
         # e.g. all conda dependencies are always lowercase
         # ref: https://bit.ly/2ITl1dS
         if any(c.isupper() for c in d):
-            print(" - {} # is this valid?".format(d))
+            print(" - {} # is this valid?".format(d), file=output)
         else:
-            print(" - {}".format(d))
+            print(" - {}".format(d), file=output)
     first = True
     for d in sorted(r_deps):
         # make sure R is listed as a dependency
         if first:
-            print(" - r-base")
+            print(" - r-base", file=output)
             first = False
         # add sanity check for suspicious dependencies
         # e.g. all conda dependencies are always lowercase
@@ -465,32 +2146,60 @@ def print_conda_env(python_deps, r_deps, envname="myenv",
         if any(c.isupper() for c in d) or \
             (not d.startswith("r-") and \
              not d.startswith("bioconductor-")):
-            print(" - {} # is this valid?".format(d))
+            print(" - {} # is this valid?".format(d), file=output)
         else:
-            print(" - {}".format(d))
+            print(" - {}".format(d), file=output)
 
 
-def main(argv=None):
-    """script main.
-    parses command line options in sys.argv, unless *argv* is given.
-    """
+def print_deps_changes(commit, old_deps, new_deps, output=None):
+    '''
+       Print the conda packages added (+) and removed (-) in
+       a commit, to "output" if given or to the standard output
+    '''
 
-    if argv is None:
-        argv = sys.argv
+    print("commit {}".format(commit), file=output)
+    for d in sorted(new_deps - old_deps):
+        print(" + {}".format(d), file=output)
+    for d in sorted(old_deps - new_deps):
+        print(" - {}".format(d), file=output)
+
+
+def get_parser():
+    '''
+       Auxiliary function to set up the command line parser
+    '''
 
-    # setup command line parser
     parser = argparse.ArgumentParser(
         description='Translate Python dependencies into a conda environment file.')
 
-    parser.add_argument("filename", help="Path to Python file")
+    parser.add_argument("filename", help="Path to Python file, folder or archive (e.g. .tar.gz, .whl)")
     parser.add_argument("--debug",
                         help="Print debugging info",
                         action="store_true",
                         default=False)
     parser.add_argument("--exclude-folder",
-                        help="Path to a folder to exclude",
+                        help="Path or glob pattern (e.g. '**/tests/data') of folders to exclude",
                         action="append",
                         default=[])
+    parser.add_argument("--git",
+                        help="Get the files to scan from the git index instead of walking folders",
+                        action="store_true",
+                        default=False)
+    parser.add_argument("--rev",
+                        help="Scan the files in this commit of the git repository instead of "
+                             "the work tree, without checking it out (e.g. a tag)")
+    parser.add_argument("--history",
+                        help="Print the dependencies added and removed in each commit "
+                             "of a range of the git repository (e.g. v1.0..HEAD)")
+    parser.add_argument("--no-default-excludes",
+                        help="Also scan folders that are excluded by default (e.g. .git, __pycache__)",
+                        action="store_true",
+                        default=False)
+    parser.add_argument("--follow-symlinks",
+                        help="Follow symbolic links to folders, scanning each folder and file once "
+                             "however many links lead to it",
+                        action="store_true",
+                        default=False)
     parser.add_argument(
         "--include-py-json",
         help="Path to a json file with project specific translations for Python",
@@ -506,38 +2215,182 @@ def main(argv=None):
         help="Path to additional Python files and/or folders to scan",
         action="append",
         default=[])
+    parser.add_argument(
+        "--jobs",
+        help="Number of processes used to scan files (default: number of CPUs)",
+        type=int,
+        default=os.cpu_count() or 1)
+
+    parser.add_argument("-o", "--output",
+                        help="Write the conda environment file here instead of the standard output")
+    parser.add_argument("--incremental",
+                        help="Keep the scan results in a manifest next to the output file "
+                             "and only scan files that changed since the last run",
+                        action="store_true",
+                        default=False)
+    parser.add_argument("--watch",
+                        help="Keep watching the files after the scan and update the "
+                             "output file whenever the dependencies change",
+                        action="store_true",
+                        default=False)
+    parser.add_argument("--since",
+                        help="With --incremental and --git, find changed files with "
+                             "git diff against this commit instead of the one in the manifest")
+
+    parser.add_argument("--profile",
+                        help="Print the time spent in each phase of the scan",
+                        action="store_true",
+                        default=False)
+    parser.add_argument("--no-cache",
+                        help="Do not use the persistent scan cache",
+                        action="store_true",
+                        default=False)
+    parser.add_argument(
+        "--cache-dir",
+        help="Folder for the persistent scan cache (default: ~/.cache/conda_deps)",
+        default=get_cache_folder())
+    parser.add_argument(
+        "--cache-hash",
+        help="Compare file contents when size or modification time changed",
+        action="store_true",
+        default=False)
+
+    return parser
 
-    options = parser.parse_args()
+
+def main(argv=None, cache=None):
+    """script main.
+    parses command line options in sys.argv, unless *argv* is given.
+
+    A long running process can give an open "cache" to use instead
+    of the persistent scan cache.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    if argv[1:2] == ['serve']:
+        from . import server
+        return server.main(argv[1:])
+
+    parser = get_parser()
+    options = parser.parse_args(argv[1:])
+
+    if options.jobs < 1:
+        parser.error("--jobs must be a positive number")
+
+    if options.incremental and options.output is None:
+        parser.error("--incremental requires --output")
+
+    if options.since is not None and not (options.incremental and options.git):
+        parser.error("--since requires --incremental and --git")
+
+    if options.rev is not None and options.incremental:
+        parser.error("--rev can not be used with --incremental")
+
+    if options.history is not None and (options.rev is not None or options.incremental):
+        parser.error("--history can not be used with --rev or --incremental")
+
+    if options.watch:
+        if options.output is None:
+            parser.error("--watch requires --output")
+        if options.rev is not None or options.history is not None or options.incremental:
+            parser.error("--watch can not be used with --rev, --history or --incremental")
+
+    # archives are only read by plain scans
+    archives = [f for f in [options.filename] + options.include_files if is_archive(f)]
+    if archives:
+        for (option, enabled) in (('--incremental', options.incremental),
+                                  ('--watch', options.watch),
+                                  ('--rev', options.rev is not None)):
+            if enabled:
+                parser.error("{} can not be used with archives: {}".format(
+                    option, ', '.join(archives)))
 
     # configure logging
     config_logging(options.debug)
 
-    # get a list of all Python files inside the folder
-    global PY_LOCAL
-    PY_LOCAL = get_local_imports(options.filename)
+    # open persistent cache with previous scans
+    if options.no_cache:
+        cache = None
+    elif cache is None:
+        try:
+            cache = ScanCache(options.cache_dir, options.cache_hash)
+        except (OSError, sqlite3.Error) as e:
+            logging.warning("Could not open scan cache in {}: {}".format(
+                options.cache_dir, e))
+
+    profile = Profile(options.profile)
+
+    scanner = Scanner(options.exclude_folder, not options.no_default_excludes,
+                      options.jobs, cache, profile,
+                      follow_symlinks=options.follow_symlinks)
 
     # update default translation dict with project specific ones
     for j in options.include_py_json:
-        PY_DEPS.update(json.load(open(j)))
+        scanner.add_py_translations(j)
 
     # update default translation dict with project specific ones
     for j in options.include_r_json:
-        R_DEPS.update(json.load(open(j)))
+        scanner.add_r_translations(j)
+
+    roots = [options.filename] + options.include_files
+
+    if options.watch:
+        scanner.watch(roots, options.output)
+        return
+
+    if options.history is not None:
+        with contextlib.ExitStack() as stack:
+            output = None
+            if options.output is not None:
+                output = stack.enter_context(open(options.output, 'w'))
+
+            # the first commit is the one before the range
+            deps = None
+            for (commit, python_deps, r_deps) in scanner.scan_history(
+                    options.filename, options.history):
+                with profile.phase('output'):
+                    new_deps = python_deps | r_deps
+                    if deps is not None:
+                        print_deps_changes(commit, deps, new_deps, output)
+                    deps = new_deps
+
+        scanner.close()
+        if profile.enabled:
+            profile.report()
+        return
 
     # get dependencies
-    (python_deps, r_deps) = check_deps(options.filename, list(
-        map(os.path.abspath, options.exclude_folder)))
+    if options.incremental:
+        (python_deps, r_deps) = scanner.scan_incremental(
+            options.output, roots, options.git, options.since)
+    elif options.rev is not None:
+        (python_deps, r_deps) = scanner.scan_rev(
+            options.filename, options.rev, options.include_files)
+    else:
+        (python_deps, r_deps) = scanner.scan(
+            options.filename, options.include_files, options.git)
+
+    with profile.phase('output'):
+        scanner.close()
 
-    # scan additional dependencies
-    for f in options.include_files:
-        (deps_py, deps_r) = check_deps(f, list(
-            map(os.path.abspath, options.exclude_folder)))
-        python_deps.update(deps_py)
-        r_deps.update(deps_r)
+        # print info about dependencies
+        if options.output is not None:
+            with open(options.output, 'w') as f:
+                print_conda_env(python_deps, r_deps, output=f)
+        else:
+            print_conda_env(python_deps, r_deps)
+            sys.stdout.flush()
 
-    # print info about dependencies
-    print_conda_env(python_deps, r_deps)
+    if profile.enabled:
+        profile.report()
 
 
 if __name__ == "__main__":
+    if __package__:
+        # with python -m, run the copy of this module that the rest of
+        # the package imports, so they share the same classes
+        from conda_deps import conda_deps
+        sys.exit(conda_deps.main(sys.argv))
     sys.exit(main(sys.argv))
@@ -0,0 +1,396 @@
+'''
+Auxiliary functions to get the files to scan from git repositories,
+using nothing but the local git binary.
+'''
+
+import os
+import logging
+import threading
+import contextlib
+import subprocess
+import collections
+import concurrent.futures
+
+from .conda_deps import (IGNORE_FILE, NO_PROFILE, filter_files, parse_ignore_file,
+                         decode_file, get_language, get_local_imports,
+                         extract_all_data, merge_results, init_worker)
+
+
+def run_git(folder, *args):
+    '''
+       Auxiliary function to run a git command inside
+       a folder and return its output as bytes
+    '''
+
+    command = ['git', '-C', folder] + list(args)
+    logging.debug('Running: {}'.format(' '.join(command)))
+
+    return subprocess.run(command, check=True,
+                          stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE).stdout
+
+
+def is_git_repository(folder):
+    '''
+       Auxiliary function to test whether a folder
+       is inside the work tree of a git repository
+    '''
+
+    if not os.path.isdir(folder):
+        return False
+
+    try:
+        output = run_git(folder, 'rev-parse', '--is-inside-work-tree')
+    except (OSError, subprocess.CalledProcessError):
+        return False
+
+    return output.strip() == b'true'
+
+
+def list_index(folder):
+    '''
+       Auxiliary function to get the files in the git index below
+       a folder, as a dictionary from the path relative to the folder
+       to the git object ID of the contents.
+
+       The object ID is None for files that were modified in the
+       work tree since they were staged, as well as symbolic links,
+       because then it does not describe what is on disk
+    '''
+
+    result = {}
+
+    # https://git-scm.com/docs/git-ls-files
+    # each entry is "<mode> <object> <stage>\t<file>"
+    output = run_git(folder, 'ls-files', '--stage', '-z')
+    for entry in output.split(b'\0'):
+        if not entry:
+            continue
+        (info, path) = entry.split(b'\t', 1)
+        (mode, blob, stage) = info.split(b' ')
+        path = os.fsdecode(path)
+        if mode == b'160000':
+            # submodules
+            continue
+        if mode == b'120000':
+            # symbolic links
+            result[path] = None
+        else:
+            result[path] = blob.decode()
+
+    # files that changed on disk or were deleted
+    output = run_git(folder, 'ls-files', '--modified', '-z')
+    for path in output.split(b'\0'):
+        if path:
+            result[os.fsdecode(path)] = None
+
+    output = run_git(folder, 'ls-files', '--deleted', '-z')
+    for path in output.split(b'\0'):
+        if path:
+            result.pop(os.fsdecode(path), None)
+
+    return result
+
+
+def collect_git_files(folder, exclude_folder, default_excludes=True):
+    '''
+       Auxiliary function to get the files to scan from the git index
+       instead of walking the folder, which leaves out untracked files
+       (e.g. pipeline outputs). Exclusions are applied the same way as
+       in collect_files.
+
+       Returns the list of files to scan and a dictionary with their
+       git object IDs, to be used as cache keys
+    '''
+
+    index = list_index(folder)
+
+    scan_files = []
+    blobs = {}
+    for path in filter_files(folder, sorted(index), exclude_folder,
+                             default_excludes):
+        filename = os.path.join(folder, path)
+        scan_files.append(filename)
+        if index[path] is not None:
+            blobs[filename] = index[path]
+
+    logging.debug('Found {} files to scan in the git index of {}'.format(
+        len(scan_files), folder))
+
+    return scan_files, blobs
+
+
+def get_head(folder):
+    '''
+       Auxiliary function to get the object ID of the commit
+       checked out in a git repository, or None if there is none
+    '''
+
+    try:
+        return run_git(folder, 'rev-parse', '--verify', 'HEAD').strip().decode()
+    except subprocess.CalledProcessError:
+        return None
+
+
+def list_changes(folder, ref):
+    '''
+       Auxiliary function to get the files below a folder that differ
+       between the commit "ref" and the work tree, as paths relative
+       to the folder. Like collect_git_files, only files known to
+       git are considered. Returns two sets: files that were added
+       or modified and files that were deleted
+    '''
+
+    changed = set()
+    deleted = set()
+
+    # https://git-scm.com/docs/git-diff
+    # with -z, the output is "<status>\0<file>\0" for each file
+    output = run_git(folder, 'diff', '--name-status', '--no-renames',
+                     '--relative', '-z', ref, '--')
+    tokens = output.split(b'\0')
+    for (status, path) in zip(tokens[0::2], tokens[1::2]):
+        if status == b'D':
+            deleted.add(os.fsdecode(path))
+        else:
+            changed.add(os.fsdecode(path))
+
+    return changed, deleted
+
+
+def list_tree(folder, rev):
+    '''
+       Auxiliary function to get the files below a folder in the
+       commit "rev", as a dictionary from the path relative to the
+       folder to the git object ID of the contents. Symbolic links
+       and submodules are left out
+    '''
+
+    result = {}
+
+    # https://git-scm.com/docs/git-ls-tree
+    # each entry is "<mode> <type> <object>\t<file>"
+    output = run_git(folder, 'ls-tree', '-r', '-z', rev)
+    for entry in output.split(b'\0'):
+        if not entry:
+            continue
+        (info, path) = entry.split(b'\t', 1)
+        (mode, kind, blob) = info.split(b' ')
+        if kind != b'blob' or mode == b'120000':
+            continue
+        result[os.fsdecode(path)] = blob.decode()
+
+    return result
+
+
+def read_blobs(folder, blobs):
+    '''
+       Auxiliary function to read the contents of many git objects
+       through a single "git cat-file --batch" process. Object IDs
+       are written by a separate thread, so git never waits for the
+       next request. Yields a tuple (object ID, bytes) for each one,
+       in the same order
+    '''
+
+    command = ['git', '-C', folder, 'cat-file', '--batch']
+    logging.debug('Running: {}'.format(' '.join(command)))
+    process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE)
+
+    def feed():
+        try:
+            for blob in blobs:
+                process.stdin.write(blob.encode() + b'\n')
+            process.stdin.close()
+        except (BrokenPipeError, ValueError):
+            pass
+
+    thread = threading.Thread(target=feed, daemon=True)
+    thread.start()
+
+    try:
+        for blob in blobs:
+            # https://git-scm.com/docs/git-cat-file#_batch_output
+            # each object is "<object> <type> <size>\n<contents>\n"
+            header = process.stdout.readline().split()
+            if len(header) != 3:
+                raise IOError("Could not read git object {}".format(blob))
+            data = process.stdout.read(int(header[2]))
+            process.stdout.read(1)
+            yield blob, data
+    finally:
+        process.stdout.close()
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+        thread.join()
+
+
+def collect_rev_files(folder, rev, exclude_folder, default_excludes=True):
+    '''
+       Auxiliary function to get the files to scan from the commit
+       "rev" of a git repository, without checking it out. Exclusions
+       are applied the same way as in collect_files, reading the
+       .condadepsignore file from the commit as well.
+
+       Returns a dictionary from the path relative to the
+       folder to the git object ID of the contents
+    '''
+
+    tree = list_tree(folder, rev)
+
+    ignore_patterns = []
+    if IGNORE_FILE in tree:
+        for (blob, data) in read_blobs(folder, [tree[IGNORE_FILE]]):
+            ignore_patterns = parse_ignore_file(decode_file(data).splitlines())
+
+    result = {}
+    for path in filter_files(folder, sorted(tree), exclude_folder,
+                             default_excludes, ignore_patterns):
+        result[path] = tree[path]
+
+    logging.debug('Found {} files to scan in {} of {}'.format(
+        len(result), rev, folder))
+
+    return result
+
+
+def scan_blobs(folder, pending, paths, executor=None, window=4, profile=None):
+    '''
+       Auxiliary function to scan git objects given by their cache
+       keys ("<object ID>:<language>") in "pending", using the first
+       path in "paths" for each key to choose the scanners. Objects
+       are read with read_blobs and handed to extract_all_data.
+       Yields a tuple (key, result) for each key
+    '''
+
+    blobs = [key.partition(':')[0] for key in pending]
+    contents = ((key, paths[key][0], data)
+                for (key, (blob, data)) in zip(pending, read_blobs(folder, blobs)))
+
+    return extract_all_data(contents, executor, window, profile)
+
+
+def extract_rev_files(folder, files, jobs=1, cache=None, profile=None,
+                      results=None, executor=None):
+    '''
+       Auxiliary function to extract the raw names from files in
+       a git repository, given as a dictionary from path to git
+       object ID (see collect_rev_files). The contents are handed
+       to the scanners, either in this process or with a pool of
+       "jobs" worker processes (or the pool given in "executor").
+
+       Each object is only scanned once per language, and the results
+       are kept in the cache. When scanning many commits, a dictionary
+       given in "results" keeps them in memory too. Yields a tuple
+       (path, result) for each file, in no particular order
+    '''
+
+    if profile is None:
+        profile = NO_PROFILE
+
+    if results is None:
+        results = {}
+
+    # files sharing the same contents, by cache key
+    paths = collections.defaultdict(list)
+    for (path, blob) in files.items():
+        paths['{}:{}'.format(blob, get_language(path))].append(path)
+
+    pending = []
+    with profile.phase('cache'):
+        for (key, same) in paths.items():
+            cached = results.get(key)
+            if cached is None and cache is not None:
+                cached = cache.get_blob(key)
+                if cached is not None:
+                    results[key] = cached
+            if cached is not None:
+                if profile.enabled:
+                    profile.files['cache'] += len(same)
+                for path in same:
+                    yield path, cached
+            else:
+                pending.append(key)
+
+    with profile.phase('scan'):
+        with contextlib.ExitStack() as stack:
+            if executor is None and jobs > 1 and len(pending) > 1:
+                executor = stack.enter_context(concurrent.futures.ProcessPoolExecutor(
+                    max_workers=min(jobs, len(pending)),
+                    initializer=init_worker,
+                    initargs=(logging.getLogger().isEnabledFor(logging.DEBUG),)))
+            for (key, result) in scan_blobs(folder, pending, paths,
+                                            executor, jobs * 4, profile):
+                results[key] = result
+                if cache is not None:
+                    cache.put_blob(key, result)
+                for path in paths[key]:
+                    yield path, result
+    if profile.enabled:
+        profile.files['scan'] += len(pending)
+
+
+def scan_history(scanner, folder, revisions):
+    '''
+       Auxiliary function to get the dependencies in each commit of
+       a range (e.g. v1.0..HEAD), from the oldest to the newest, with
+       the translation tables, exclusions, cache and worker processes
+       of a Scanner. Only commits that changed files below the folder
+       are considered.
+
+       As most files do not change from one commit to the next, the
+       results are kept by git object ID, so each version of a file
+       is scanned only once. Yields a tuple (commit, Python
+       dependencies, R dependencies) for each commit, starting with
+       the parent of the oldest one, to compare it with. The commit
+       is None, with no dependencies, when the range starts at the
+       first commit of the repository
+    '''
+
+    profile = scanner.profile
+
+    output = run_git(folder, 'rev-list', '--reverse', revisions, '--', '.')
+    commits = output.decode().split()
+    logging.debug('Found {} commits in {}'.format(len(commits), revisions))
+
+    # the dependencies before the range are those of the
+    # first parent of the oldest commit, if any
+    base = None
+    if commits:
+        output = run_git(folder, 'rev-list', '--parents', '--max-count=1', commits[0])
+        parents = output.decode().split()[1:]
+        if parents:
+            base = parents[0]
+
+    results = {}
+
+    with contextlib.ExitStack() as stack:
+        executor = None
+        if scanner.jobs > 1:
+            executor = stack.enter_context(concurrent.futures.ProcessPoolExecutor(
+                max_workers=scanner.jobs,
+                initializer=init_worker,
+                initargs=(logging.getLogger().isEnabledFor(logging.DEBUG),)))
+
+        for commit in [base] + commits:
+            if commit is None:
+                yield None, set(), set()
+                continue
+
+            with profile.phase('walk'):
+                files = collect_rev_files(folder, commit, scanner.exclude_folder,
+                                          scanner.default_excludes)
+                scanner.local_modules = get_local_imports(
+                    folder, [os.path.join(folder, p) for p in files])
+            if profile.enabled:
+                profile.files['walk'] += len(files)
+
+            found = extract_rev_files(folder, files, scanner.jobs, scanner.cache,
+                                      profile, results, executor)
+            (python_imports, r_imports, magics) = merge_results(
+                r for (path, r) in found)
+
+            (python_deps, r_deps) = scanner.resolve(python_imports, r_imports, magics)
+
+            yield commit, python_deps, r_deps
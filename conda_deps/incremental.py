@@ -0,0 +1,264 @@
+'''
+Incremental scans: the raw names found in each file are kept in a
+manifest next to the environment file, so later runs only scan the
+files that were added or modified since (by size and modification
+time, or with git diff against a commit) and drop deleted files.
+'''
+
+import os
+import json
+import logging
+import subprocess
+
+from . import conda_deps
+
+
+def get_manifest_filename(output):
+    '''
+       Auxiliary function to get the path of the manifest
+       kept next to an environment file
+    '''
+
+    return output + '.manifest.json'
+
+
+def read_manifest(filename):
+    '''
+       Auxiliary function to read a manifest, or
+       to get None if there is no valid one
+    '''
+
+    if not os.path.isfile(filename):
+        return None
+
+    try:
+        with open(filename) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning("Could not read manifest {}: {}".format(filename, e))
+        return None
+
+    if manifest.get('version') != conda_deps.scanner_fingerprint():
+        logging.debug('Discarding manifest {} from another version'.format(filename))
+        return None
+
+    return manifest
+
+
+def write_manifest(filename, manifest):
+    '''
+       Auxiliary function to write a manifest, replacing
+       the previous one only once it is complete
+    '''
+
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, sort_keys=True)
+    os.replace(tmp, filename)
+
+
+def get_settings(base, roots, exclude_folder, default_excludes, use_git,
+                 follow_symlinks=False):
+    '''
+       Auxiliary function to describe the options that decide
+       which files are scanned. When they change, the manifest
+       can not be used and all files are scanned again
+    '''
+
+    return {'roots': [os.path.relpath(r, base) for r in roots],
+            'exclude_folder': dict(exclude_folder.patterns,
+                                   paths=sorted(exclude_folder.paths)),
+            'ignore_files': [conda_deps.read_ignore_file(r) for r in roots],
+            'default_excludes': default_excludes,
+            'follow_symlinks': follow_symlinks,
+            'git': use_git}
+
+
+def find_git_changes(root, previous, exclude_folder, default_excludes, since):
+    '''
+       Auxiliary function to get the files to scan again in a git
+       repository, comparing the work tree with the commit "since"
+       or the commit recorded in the manifest. Files that differed
+       from that commit when the manifest was written are scanned
+       again too, as git no longer reports them if they went back
+       to their committed contents.
+
+       Returns the files to scan and the files to drop, as paths
+       relative to the root, or None if git can not tell
+    '''
+
+    from . import gitscan
+
+    ref = since or previous.get('commit')
+    if ref is None:
+        return None
+
+    try:
+        (changed, deleted) = gitscan.list_changes(root, ref)
+    except subprocess.CalledProcessError as e:
+        logging.warning("Could not compare {} with {}: {}".format(
+            root, ref, e.stderr.decode(errors='replace').strip()))
+        return None
+
+    changed.update(previous.get('dirty', []))
+    changed = {p for p in changed if os.path.isfile(os.path.join(root, p))}
+    rescan = conda_deps.filter_files(root, sorted(changed), exclude_folder,
+                                     default_excludes)
+
+    return rescan, deleted | (changed - set(rescan))
+
+
+def scan_root(root, previous, exclude_folder, default_excludes, use_git, since,
+              follow_symlinks=False):
+    '''
+       Auxiliary function to work out which files of a root folder
+       (or single file) have to be scanned again. Returns the
+       entries of the manifest that are still valid, the files to
+       scan again (relative to the root) and the git state to record
+    '''
+
+    from . import gitscan
+
+    files = {}
+    rescan = []
+    state = {}
+
+    is_git = use_git and gitscan.is_git_repository(root)
+    if use_git and not is_git and os.path.isdir(root):
+        logging.warning("{} is not a git repository, walking it instead".format(root))
+
+    changes = None
+    if is_git:
+        state['commit'] = gitscan.get_head(root)
+        if previous is not None:
+            changes = find_git_changes(root, previous, exclude_folder,
+                                       default_excludes, since)
+
+    if changes is not None:
+        (rescan, deleted) = changes
+        files = dict(previous['files'])
+        for p in deleted:
+            files.pop(p, None)
+        for p in rescan:
+            files.pop(p, None)
+    else:
+        if is_git:
+            (scan_files, blobs) = gitscan.collect_git_files(
+                root, exclude_folder, default_excludes)
+        else:
+            scan_files = conda_deps.collect_files(root, exclude_folder,
+                                                  default_excludes, follow_symlinks)
+        old_files = previous['files'] if previous is not None else {}
+        for f in scan_files:
+            p = os.path.relpath(f, root) if os.path.isdir(root) else ''
+            entry = old_files.get(p)
+            if entry is not None and not is_git:
+                try:
+                    st = os.stat(f)
+                except OSError:
+                    continue
+                if entry.get('size') == st.st_size and \
+                        entry.get('mtime_ns') == st.st_mtime_ns:
+                    files[p] = entry
+                    continue
+            rescan.append(p)
+
+    if is_git and state['commit'] is not None:
+        # files that differ from the commit just recorded
+        (changed, deleted) = gitscan.list_changes(root, state['commit'])
+        state['dirty'] = sorted(changed | deleted)
+
+    return files, rescan, state
+
+
+def scan_incremental(scanner, output, roots, use_git=False, since=None):
+    '''
+       Scan the files in "roots" (the first one is the main folder)
+       with the translation tables, exclusions, cache and worker
+       processes of a Scanner, reusing the results kept in the
+       manifest of the environment file "output", then write the
+       updated manifest.
+
+       Only files that were added or modified since the manifest was
+       written are scanned. With "use_git", changes in git repositories
+       are found with git diff against the commit recorded in the
+       manifest, or against "since" if given. Otherwise, files are
+       compared by size and modification time.
+
+       Returns the Python and R dependencies, as scan_all_files
+    '''
+
+    exclude_folder = scanner.exclude_folder
+    default_excludes = scanner.default_excludes
+    profile = scanner.profile
+
+    manifest_file = get_manifest_filename(output)
+    base = os.path.dirname(os.path.abspath(manifest_file))
+    roots = [os.path.abspath(r) for r in roots]
+
+    settings = get_settings(base, roots, exclude_folder, default_excludes, use_git,
+                            scanner.follow_symlinks)
+    manifest = read_manifest(manifest_file)
+    if manifest is not None and manifest.get('settings') != settings:
+        logging.debug('Options changed since {} was written'.format(manifest_file))
+        manifest = None
+    if manifest is None:
+        logging.debug('Scanning all files')
+        previous_roots = [None] * len(roots)
+    else:
+        previous_roots = manifest['roots']
+
+    with profile.phase('walk'):
+        new_roots = []
+        pending = []
+        for (root, previous) in zip(roots, previous_roots):
+            (files, rescan, state) = scan_root(root, previous, exclude_folder,
+                                               default_excludes, use_git, since,
+                                               scanner.follow_symlinks)
+            state['files'] = files
+            new_roots.append(state)
+            for p in rescan:
+                pending.append((len(new_roots) - 1, p))
+
+    # stat the files before they are read, so changes made
+    # while scanning are picked up by the next run. A file can
+    # be in several roots, but it is only scanned once
+    paths = {}
+    stats = {}
+    for (i, p) in pending:
+        f = os.path.join(roots[i], p) if p else roots[i]
+        paths.setdefault(f, []).append((i, p))
+        try:
+            stats[f] = os.stat(f)
+        except OSError:
+            pass
+
+    for (f, result) in conda_deps.extract_all_files(list(paths), scanner.jobs,
+                                                    scanner.cache, profile):
+        for (i, p) in paths[f]:
+            entry = {'result': result}
+            if f in stats:
+                entry['size'] = stats[f].st_size
+                entry['mtime_ns'] = stats[f].st_mtime_ns
+            new_roots[i]['files'][p] = entry
+
+    logging.debug('Scanned {} files, reused {} files from {}'.format(
+        len(paths),
+        sum(len(r['files']) for r in new_roots) - len(pending),
+        manifest_file))
+
+    # local modules are worked out from all the files in the main folder
+    scanner.local_modules = conda_deps.get_local_imports(
+        roots[0], [os.path.join(roots[0], p) for p in new_roots[0]['files']])
+
+    (python_imports, r_imports, magics) = conda_deps.merge_results(
+        entry['result'] for r in new_roots for entry in r['files'].values())
+
+    deps = scanner.resolve(python_imports, r_imports, magics)
+
+    write_manifest(manifest_file,
+                   {'version': conda_deps.scanner_fingerprint(),
+                    'settings': settings,
+                    'roots': new_roots})
+
+    return deps
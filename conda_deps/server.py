@@ -0,0 +1,241 @@
+'''
+Daemon mode: conda_deps serve listens on a Unix domain socket and
+runs the scans requested by conda_deps_client in a single long running
+process, so the translation tables, the classification of standard
+library modules and the results of each file stay warm between scans.
+
+Requests are handled one at a time. Only processes of the user running
+the daemon can connect to it, as it reads files with their permissions.
+'''
+
+import os
+import io
+import sys
+import json
+import stat
+import errno
+import socket
+import struct
+import signal
+import logging
+import sqlite3
+import argparse
+import traceback
+import contextlib
+import socketserver
+
+from . import conda_deps
+from .client import get_socket_path, send_request
+
+class Handler(socketserver.StreamRequestHandler):
+    '''
+       Run the scan requested by a client
+    '''
+
+    def handle(self):
+        if not self.server.is_allowed(self.request):
+            logging.warning('Rejected connection from another user')
+            return
+
+        try:
+            request = json.loads(self.rfile.read().decode())
+            response = self.server.scan(request['argv'], request['cwd'])
+        except (ValueError, KeyError) as e:
+            response = {'stdout': '', 'stderr': 'Invalid request: {}\n'.format(e),
+                        'status': 2}
+
+        self.wfile.write(json.dumps(response).encode())
+
+
+class ScanServer(socketserver.UnixStreamServer):
+    '''
+       Server handling one request at a time, with a cache shared
+       by all of them. Each request gets its own Scanner, starting
+       from the translation tables loaded once by the daemon
+    '''
+
+    def __init__(self, path, cache):
+        super().__init__(path, Handler)
+        os.chmod(path, 0o600)
+        self.cache = cache
+
+    def is_allowed(self, connection):
+        '''
+           Whether the process at the other end of a connection
+           belongs to the user running the daemon
+        '''
+
+        if not hasattr(socket, 'SO_PEERCRED'):
+            # the socket can only be opened by its owner anyway
+            return True
+        # struct ucred: pid_t pid; uid_t uid; gid_t gid
+        creds = connection.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED,
+                                      struct.calcsize('3i'))
+        (pid, uid, gid) = struct.unpack('3i', creds)
+        return uid == os.getuid()
+
+    def is_supported(self, argv):
+        '''
+           Whether a command line can be run by the daemon. Watching
+           files never ends and would block all later requests, and
+           starting another daemon would wait for this one. The
+           command line is parsed as conda_deps does, so abbreviated
+           options are recognised too. Returns an error message if it
+           can not be run, or None otherwise
+        '''
+
+        if argv[:1] == ['serve']:
+            return 'serve is not supported by conda_deps serve'
+
+        # invalid command lines are reported by conda_deps itself
+        try:
+            with contextlib.redirect_stdout(io.StringIO()), \
+                    contextlib.redirect_stderr(io.StringIO()):
+                options = conda_deps.get_parser().parse_args(argv)
+        except SystemExit:
+            return None
+        if options.watch:
+            return '--watch is not supported by conda_deps serve'
+        return None
+
+    def scan(self, argv, cwd):
+        '''
+           Run conda_deps with the given command line in the folder
+           "cwd" and return what it printed and its exit status
+        '''
+
+        error = self.is_supported(argv)
+        if error is not None:
+            return {'stdout': '', 'stderr': error + '\n', 'status': 2}
+
+        logging.debug('Scan requested in {}: {}'.format(cwd, ' '.join(argv)))
+
+        folder = os.getcwd()
+        root_logger = logging.getLogger()
+        handlers = list(root_logger.handlers)
+        level = root_logger.level
+
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+        status = 0
+        try:
+            os.chdir(cwd)
+            root_logger.handlers = []
+            with contextlib.redirect_stdout(stdout), \
+                    contextlib.redirect_stderr(stderr):
+                try:
+                    status = conda_deps.main(['conda_deps'] + argv, self.cache)
+                except SystemExit as e:
+                    status = e.code
+                except Exception:
+                    traceback.print_exc()
+                    status = 1
+        finally:
+            os.chdir(folder)
+            root_logger.handlers = handlers
+            root_logger.setLevel(level)
+
+        if status is None:
+            status = 0
+        elif not isinstance(status, int):
+            stderr.write('{}\n'.format(status))
+            status = 1
+
+        return {'stdout': stdout.getvalue(), 'stderr': stderr.getvalue(),
+                'status': status}
+
+
+def remove_stale_socket(path):
+    '''
+       Auxiliary function to remove the socket left behind by
+       a daemon that is no longer running
+    '''
+
+    if not os.path.exists(path):
+        return
+    if not stat.S_ISSOCK(os.stat(path).st_mode):
+        raise OSError(errno.EEXIST, '{} exists and is not a socket'.format(path))
+    try:
+        send_request(path, {})
+    except ConnectionRefusedError:
+        logging.debug('Removing stale socket {}'.format(path))
+        os.unlink(path)
+        return
+    raise OSError(errno.EADDRINUSE,
+                  'conda_deps serve is already running on {}'.format(path))
+
+
+def serve(path, cache=None):
+    '''
+       Run the daemon listening on the socket "path"
+       until interrupted or terminated
+    '''
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    remove_stale_socket(path)
+
+    # load the tables now, so the first request is as fast as the rest
+    conda_deps.is_python_std_module('sys')
+
+    # stop cleanly when terminated, e.g. by a service manager
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    with ScanServer(path, cache) as server:
+        logging.info('Listening on {}'.format(path))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(path)
+            if cache is not None:
+                cache.close()
+
+
+def main(argv=None):
+    """script main.
+    parses command line options in sys.argv, unless *argv* is given.
+    """
+
+    if argv is None:
+        argv = sys.argv
+
+    parser = argparse.ArgumentParser(
+        prog='conda_deps serve',
+        description='Keep conda_deps running and scan files requested by conda_deps_client.')
+
+    parser.add_argument("--socket",
+                        help="Path of the Unix domain socket to listen on "
+                             "(default: $CONDA_DEPS_SOCKET or $XDG_RUNTIME_DIR/conda_deps.sock)",
+                        default=get_socket_path())
+    parser.add_argument("--debug",
+                        help="Print debugging info",
+                        action="store_true",
+                        default=False)
+    parser.add_argument("--no-cache",
+                        help="Do not use the persistent scan cache (results are still kept in memory)",
+                        action="store_true",
+                        default=False)
+    parser.add_argument(
+        "--cache-dir",
+        help="Folder for the persistent scan cache (default: ~/.cache/conda_deps)",
+        default=conda_deps.get_cache_folder())
+    parser.add_argument(
+        "--cache-hash",
+        help="Compare file contents when size or modification time changed",
+        action="store_true",
+        default=False)
+
+    options = parser.parse_args(argv[1:])
+
+    conda_deps.config_logging(options.debug)
+
+    backing = None
+    if not options.no_cache:
+        try:
+            backing = conda_deps.ScanCache(options.cache_dir, options.cache_hash)
+        except (OSError, sqlite3.Error) as e:
+            logging.warning("Could not open scan cache in {}: {}".format(
+                options.cache_dir, e))
+
+    serve(options.socket, conda_deps.MemoryCache(backing))
@@ -0,0 +1,320 @@
+'''
+Watch mode: after an initial scan, the environment file is kept up to
+date as files change. Changes are reported by inotify on Linux, and
+found by checking the size and modification time of the files every
+few seconds elsewhere. Only the files that changed are scanned again,
+and the environment file is only written when the dependencies change.
+'''
+
+import os
+import sys
+import errno
+import time
+import select
+import struct
+import logging
+import ctypes
+import ctypes.util
+
+from . import conda_deps
+
+# https://man7.org/linux/man-pages/man7/inotify.7.html
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+# events that change files to scan
+IN_WATCH_MASK = (IN_CLOSE_WRITE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO |
+                 IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+
+# struct inotify_event: int wd; uint32_t mask, cookie, len; char name[]
+INOTIFY_EVENT = struct.Struct('iIII')
+
+# seconds to wait for more events before scanning,
+# as saving a file usually triggers several of them
+SETTLE_TIME = 0.2
+
+
+class Inotify:
+    '''
+       Minimal wrapper around the inotify API of Linux,
+       called through ctypes
+    '''
+
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise OSError(errno.ENOSYS, 'inotify is only available on Linux')
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self.folders = {}
+
+    def add_watch(self, folder):
+        '''
+           Start watching a folder
+        '''
+
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder),
+                                         IN_WATCH_MASK | IN_ONLYDIR)
+        if wd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e), folder)
+        self.folders[wd] = folder
+
+    def read(self, timeout=None):
+        '''
+           Wait up to "timeout" seconds (forever if None) for events.
+           Returns a list of tuples (path, mask), where the path is
+           None when events were lost
+        '''
+
+        (ready, _, _) = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+
+        data = os.read(self.fd, 1 << 16)
+        events = []
+        offset = 0
+        while offset < len(data):
+            (wd, mask, cookie, length) = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                events.append((None, mask))
+                continue
+            folder = self.folders.get(wd)
+            if mask & IN_IGNORED:
+                # the folder is no longer watched
+                self.folders.pop(wd, None)
+                continue
+            if folder is None:
+                continue
+            if name:
+                events.append((os.path.join(folder, os.fsdecode(name)), mask))
+            else:
+                events.append((folder, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Watcher:
+    '''
+       Results of the last scan of each file in "roots" (the first
+       one is the main folder), used to work out the dependencies
+       again with a Scanner when some of the files change
+    '''
+
+    def __init__(self, scanner, roots, output):
+        self.scanner = scanner
+        self.roots = roots
+        self.output = output
+        # path -> (size, modification time, result)
+        self.files = {}
+        # folders being walked, to tell whether a file has to be scanned
+        self.folders = set()
+        self.deps = None
+
+    def sync(self, cache=None):
+        '''
+           Walk all the roots again and scan the files that were
+           added or modified since the last scan. Returns the
+           folders to watch
+        '''
+
+        scan_files = []
+        self.folders = set()
+        watch_folders = set()
+        for root in self.roots:
+            if os.path.isdir(root):
+                for (dirpath, files) in conda_deps.walk_folder(
+                        root, self.scanner.exclude_folder,
+                        self.scanner.default_excludes,
+                        self.scanner.follow_symlinks):
+                    self.folders.add(dirpath)
+                    scan_files.extend(files)
+            else:
+                # single files are watched through their folder
+                watch_folders.add(os.path.dirname(root))
+                scan_files.extend(conda_deps.collect_files(
+                    root, self.scanner.exclude_folder,
+                    self.scanner.default_excludes,
+                    self.scanner.follow_symlinks))
+
+        rescan = []
+        for f in scan_files:
+            entry = self.files.get(f)
+            try:
+                st = os.stat(f)
+            except OSError:
+                continue
+            if entry is None or entry[:2] != (st.st_size, st.st_mtime_ns):
+                rescan.append(f)
+        for f in set(self.files) - set(scan_files):
+            logging.debug('File removed: {}'.format(f))
+            del self.files[f]
+
+        self.scan(rescan, cache)
+        return watch_folders | self.folders
+
+    def wanted(self, path):
+        '''
+           Whether a path is one of the files to scan
+        '''
+
+        return path.endswith(conda_deps.SCAN_EXTENSIONS) and \
+            (path in self.roots or os.path.dirname(path) in self.folders)
+
+    def touch(self, paths):
+        '''
+           Scan again the files in "paths" that changed
+           and forget the ones that were deleted
+        '''
+
+        rescan = []
+        for f in paths:
+            if not self.wanted(f):
+                continue
+            try:
+                st = os.stat(f)
+            except OSError:
+                if self.files.pop(f, None) is not None:
+                    logging.debug('File removed: {}'.format(f))
+                continue
+            entry = self.files.get(f)
+            if entry is None or entry[:2] != (st.st_size, st.st_mtime_ns):
+                rescan.append(f)
+
+        self.scan(rescan)
+
+    def scan(self, scan_files, cache=None):
+        '''
+           Scan a list of files and keep their results
+        '''
+
+        stats = {}
+        for f in scan_files:
+            try:
+                stats[f] = os.stat(f)
+            except OSError:
+                pass
+
+        for (f, result) in conda_deps.extract_all_files(list(stats),
+                                                        self.scanner.jobs, cache):
+            logging.debug('File scanned: {}'.format(f))
+            self.files[f] = (stats[f].st_size, stats[f].st_mtime_ns, result)
+
+    def update(self):
+        '''
+           Work out the dependencies from the results of all files and
+           write the environment file, only if they changed
+        '''
+
+        main = self.roots[0]
+        self.scanner.local_modules = conda_deps.get_local_imports(
+            main, [f for f in self.files if f.startswith(main + os.sep)])
+
+        (python_imports, r_imports, magics) = conda_deps.merge_results(
+            entry[2] for entry in self.files.values())
+        deps = self.scanner.resolve(python_imports, r_imports, magics)
+        if deps == self.deps:
+            return
+
+        tmp = self.output + '.tmp'
+        with open(tmp, 'w') as f:
+            conda_deps.print_conda_env(deps[0], deps[1], output=f)
+        os.replace(tmp, self.output)
+        if self.deps is not None:
+            logging.info('Dependencies changed, updated {}'.format(self.output))
+        self.deps = deps
+
+
+def watch(scanner, roots, output, interval=2.0):
+    '''
+       Scan the files in "roots" (the first one is the main folder)
+       with a Scanner, write the environment file "output" and keep
+       it up to date until interrupted. Changes are reported by
+       inotify when available, otherwise files are checked every
+       "interval" seconds. The cache of the scanner is only used
+       for the first scan
+    '''
+
+    roots = [os.path.abspath(r) for r in roots]
+    watcher = Watcher(scanner, roots, output)
+
+    try:
+        inotify = Inotify()
+    except (OSError, AttributeError) as e:
+        logging.warning('Could not use inotify ({}), checking files every {} '
+                        'seconds instead'.format(e, interval))
+        inotify = None
+
+    folders = watcher.sync(scanner.cache)
+    scanner.close()
+    watcher.update()
+
+    logging.info('Watching {} files for changes'.format(len(watcher.files)))
+
+    watched = set()
+
+    def add_watches(folders):
+        for folder in folders - watched:
+            try:
+                inotify.add_watch(folder)
+                watched.add(folder)
+            except OSError as e:
+                logging.warning('Could not watch {}: {}'.format(folder, e))
+
+    try:
+        if inotify is None:
+            while True:
+                time.sleep(interval)
+                watcher.sync()
+                watcher.update()
+
+        add_watches(folders)
+        while True:
+            events = inotify.read()
+            # wait until files are no longer changing
+            while True:
+                more = inotify.read(SETTLE_TIME)
+                if not more:
+                    break
+                events.extend(more)
+
+            resync = False
+            paths = set()
+            for (path, mask) in events:
+                if path is None or mask & (IN_ISDIR | IN_DELETE_SELF | IN_MOVE_SELF) or \
+                        os.path.basename(path) == conda_deps.IGNORE_FILE:
+                    # folders were added or removed, or exclusions
+                    # changed: walk everything again
+                    resync = True
+                else:
+                    paths.add(path)
+
+            if resync:
+                watched.intersection_update(inotify.folders.values())
+                add_watches(watcher.sync())
+            else:
+                watcher.touch(paths)
+            watcher.update()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if inotify is not None:
+            inotify.close()
@@ -19,7 +19,8 @@ setuptools.setup(
     url="https://github.com/cgat-developers/conda-deps",
     packages=setuptools.find_packages(),
     entry_points = {
-        'console_scripts': ['conda_deps=conda_deps.conda_deps:main'],
+        'console_scripts': ['conda_deps=conda_deps.conda_deps:main',
+                            'conda_deps_client=conda_deps.client:main'],
     },
     include_package_data=True,
     classifiers=[
@@ -61,6 +61,28 @@ report_error() {
     exit 1
 }
 
+# make sure importing conda_deps stays cheap:
+# the notebook stack must only be loaded when needed
+log " Checking import time of conda_deps"
+python - <<'EOF_PY'
+import sys
+import time
+start = time.perf_counter()
+import conda_deps.conda_deps
+elapsed = time.perf_counter() - start
+heavy = [m for m in ('nbformat', 'nbconvert', 'jinja2', 'traitlets', 'mistune')
+         if m in sys.modules]
+if heavy:
+    sys.exit("modules loaded at import time: {}".format(", ".join(heavy)))
+if elapsed > 0.25:
+    sys.exit("import took {:.3f} seconds".format(elapsed))
+EOF_PY
+if [[ "$?" -eq "0" ]] ; then
+    log " Test succeeded for import time!"
+else
+    report_error " Test failed for import time."
+fi
+
 # scan all python files in test folder
 ALL=`ls tests/*.py | head -1`
 for f in `ls tests/*py*` ;
@@ -86,3 +108,314 @@ if [[ "$?" -eq "0" ]] ; then
 else
     report_error " Test failed for all files together."
 fi
+
+log " Comparing serial and parallel scans: conda_deps $ALL"
+diff <(conda_deps --no-cache --jobs 1 $ALL) <(conda_deps --no-cache --jobs 4 $ALL)
+if [[ "$?" -eq "0" ]] ; then
+    log " Test succeeded for parallel scan!"
+else
+    report_error " Test failed for parallel scan."
+fi
+
+log " Comparing streamed and full scans: Scanner.iter_scan tests"
+python - <<'EOF_PY'
+import os
+import sys
+import tempfile
+from conda_deps.conda_deps import Scanner, iter_deps
+scanner = Scanner()
+# the records of all the files give the dependencies of a full scan
+python_deps = set()
+r_deps = set()
+for record in iter_deps('tests'):
+    python_deps |= record.resolved_deps[0]
+    r_deps |= record.resolved_deps[1]
+if (python_deps, r_deps) != scanner.scan('tests'):
+    sys.exit("streamed dependencies differ from a full scan")
+# a scan started in the middle of another one does not change its local modules
+with tempfile.TemporaryDirectory() as folder:
+    for name in ('a', 'b'):
+        os.mkdir(os.path.join(folder, name))
+    for i in range(3):
+        with open(os.path.join(folder, 'a', 'use{}.py'.format(i)), 'w') as f:
+            f.write('import helper\n')
+    with open(os.path.join(folder, 'b', 'helper.py'), 'w') as f:
+        f.write('import numpy\n')
+    records = scanner.iter_scan(os.path.join(folder, 'a'))
+    deps = [next(records).resolved_deps]
+    next(scanner.iter_scan(os.path.join(folder, 'b')))
+    deps.extend(record.resolved_deps for record in records)
+    if len(deps) != 3 or any('helper' not in python for (python, r) in deps):
+        sys.exit("local modules of another scan were used: {}".format(deps))
+EOF_PY
+if [[ "$?" -eq "0" ]] ; then
+    log " Test succeeded for streamed scans!"
+else
+    report_error " Test failed for streamed scans."
+fi
+
+log " Checking excluded folders: conda_deps --exclude-folder '**/tests/data'"
+EXC_DIR=`mktemp -d`
+mkdir -p $EXC_DIR/src/tests/data $EXC_DIR/.ipynb_checkpoints $EXC_DIR/pkg.egg-info \
+    $EXC_DIR/env/conda-meta $EXC_DIR/env/lib $EXC_DIR/ignored
+cp tests/experiment.py $EXC_DIR/src
+cp tests/notebook_r_kernel.ipynb $EXC_DIR/src/tests/data
+cp tests/notebook_example.ipynb $EXC_DIR/.ipynb_checkpoints
+cp tests/IndexedFasta.py $EXC_DIR/pkg.egg-info
+echo "import requests" > $EXC_DIR/env/lib/web.py
+cp tests/pipeline_rnaseqqc.py $EXC_DIR/ignored
+echo "ignored" > $EXC_DIR/.condadepsignore
+# default excludes, glob pattern and ignore file
+diff <(conda_deps --no-cache --exclude-folder '**/tests/data' $EXC_DIR) <(cat tests/experiment.yml)
+# without the glob pattern
+diff <(conda_deps --no-cache $EXC_DIR) \
+    <(conda_deps --no-cache tests/experiment.py --include-files tests/notebook_r_kernel.ipynb)
+# without default excludes, the ignore file still applies
+diff <(conda_deps --no-cache --no-default-excludes --exclude-folder '**/tests/data' $EXC_DIR) \
+    <(conda_deps --no-cache tests/experiment.py --include-files tests/notebook_example.ipynb \
+        --include-files tests/IndexedFasta.py --include-files $EXC_DIR/env/lib/web.py)
+if [[ "$?" -eq "0" ]] ; then
+    log " Test succeeded for excluded folders!"
+else
+    report_error " Test failed for excluded folders."
+fi
+rm -rf $EXC_DIR
+
+log " Comparing scans of copies of the same files: conda_deps tests"
+DUP_DIR=`mktemp -d`
+mkdir $DUP_DIR/copy1 $DUP_DIR/copy2
+cp tests/*.py tests/*.ipynb $DUP_DIR/copy1
+cp tests/*.py tests/*.ipynb $DUP_DIR/copy2
+diff <(conda_deps --no-cache $DUP_DIR) <(conda_deps --no-cache tests)
+# each file in the second copy is skipped
+DUP_COUNT=`ls $DUP_DIR/copy2 | wc -l`
+conda_deps --no-cache --jobs 1 --profile $DUP_DIR 2>&1 > /dev/null | grep "not parsed again: $DUP_COUNT$"
+if [[ "$?" -eq "0" ]] ; then
+    log " Test succeeded for copies of the same files!"
+else
+    report_error " Test failed for copies of the same files."
+fi
+rm -rf $DUP_DIR
+
+log " Comparing scans with a cold and a warm cache: conda_deps $ALL"
+CACHE_DIR=`mktemp -d`
+diff <(conda_deps --cache-dir $CACHE_DIR $ALL) <(cat tests/all.yml)
+diff <(conda_deps --cache-dir $CACHE_DIR $ALL) <(cat tests/all.yml)
+# the second scan only reads the cache
+conda_deps --cache-dir $CACHE_DIR --profile $ALL 2>&1 > /dev/null | grep -E "\] +scan +0 "
+if [[ "$?" -eq "0" ]] ; then
+    log " Test succeeded for scan cache!"
+else
+    report_error " Test failed for scan cache."
+fi
+rm -rf $CACHE_DIR
+
+log " Comparing full and incremental scans: conda_deps $ALL"
+INC_DIR=`mktemp -d`
+conda_deps --no-cache --incremental -o $INC_DIR/env.yml $ALL
+# nothing changed, so the second run reuses all the files
+conda_deps --no-cache --debug --incremental -o $INC_DIR/env.yml $ALL 2>&1 | grep "Scanned 0 files"
+diff $INC_DIR/env.yml <(cat tests/all.yml)
+if [[ "$?" -eq "0" ]] ; then
+    log " Test succeeded for incremental scan!"
+else
+    report_error " Test failed for incremental scan."
+fi
+rm -rf $INC_DIR
+
+log " Checking that --watch keeps the environment file up to date: conda_deps --watch"
+WATCH_DIR=`mktemp -d`
+mkdir $WATCH_DIR/src
+cp tests/experiment.py $WATCH_DIR/src
+# wait until the environment file matches a full scan of the folder
+wait_for_watch() {
+    conda_deps --no-cache $WATCH_DIR/src > $WATCH_DIR/expected.yml
+    for i in `seq 100` ; do
+        if diff -q $WATCH_DIR/env.yml $WATCH_DIR/expected.yml > /dev/null 2>&1 ; then
+            return 0
+        fi
+        sleep 0.1
+    done
+    diff $WATCH_DIR/env.yml $WATCH_DIR/expected.yml
+}
+conda_deps --no-cache --debug --watch -o $WATCH_DIR/env.yml $WATCH_DIR/src 2> $WATCH_DIR/watch.log &
+WATCH_PID=$!
+wait_for_watch
+# a change that keeps the dependencies does not rewrite the file
+WATCH_MTIME=`stat -c %y $WATCH_DIR/env.yml`
+echo "# no new imports" >> $WATCH_DIR/src/experiment.py
+for i in `seq 100` ; do
+    if [[ `grep -c "File scanned" $WATCH_DIR/watch.log` -ge "2" ]] ; then break ; fi
+    sleep 0.1
+done
+sleep 0.5
+WATCH_REWRITTEN=0
+[[ "$WATCH_MTIME" == `stat -c %y $WATCH_DIR/env.yml` ]] || WATCH_REWRITTEN=1
+# an edited file, a new folder and a removed file
+echo "import seaborn" >> $WATCH_DIR/src/experiment.py
+wait_for_watch
+mkdir $WATCH_DIR/src/new
+cp tests/notebook_example.ipynb $WATCH_DIR/src/new
+wait_for_watch
+rm $WATCH_DIR/src/new/notebook_example.ipynb
+wait_for_watch
+kill $WATCH_PID
+wait $WATCH_PID || true
+# the same without inotify, checking the files every interval
+python - $WATCH_DIR <<'EOF_PY'
+import os
+import sys
+import shutil
+from conda_deps import watch
+from conda_deps.conda_deps import Scanner
+folder = os.path.join(sys.argv[1], 'poll')
+output = os.path.join(sys.argv[1], 'poll.yml')
+os.mkdir(folder)
+shutil.copy('tests/experiment.py', folder)
+watcher = watch.Watcher(Scanner(), [folder], output)
+watcher.sync()
+watcher.update()
+before = os.stat(output).st_mtime_ns
+if watcher.deps != Scanner().scan(folder):
+    sys.exit("wrong dependencies after the first scan")
+with open(os.path.join(folder, 'experiment.py'), 'a') as f:
+    f.write('# no new imports\n')
+watcher.sync()
+watcher.update()
+if os.stat(output).st_mtime_ns != before:
+    sys.exit("environment file written without changes")
+os.mkdir(os.path.join(folder, 'new'))
+shutil.copy('tests/notebook_example.ipynb', os.path.join(folder, 'new'))
+watcher.sync()
+watcher.update()
+if watcher.deps != Scanner().scan(folder):
+    sys.exit("new folder not scanned")
+EOF_PY
+if [[ "$?" -eq "0" && "$WATCH_REWRITTEN" -eq "0" ]] ; then
+    log " Test succeeded for watched files!"
+else
+    report_error " Test failed for watched files."
+fi
+rm -rf $WATCH_DIR
+
+log " Comparing asynchronous and full scans: AsyncScanner $ALL"
+diff <(python - $ALL <<'EOF_PY'
+import sys
+import asyncio
+from conda_deps.conda_deps import Scanner, print_conda_env
+from conda_deps.aio import AsyncScanner
+filename = sys.argv[1]
+include_files = sys.argv[3::2]
+async def main():
+    scanner = AsyncScanner(Scanner(jobs=2), limit=2)
+    try:
+        # several scans at the same time share the worker processes
+        results = await asyncio.gather(*[scanner.scan(filename, include_files)
+                                         for i in range(3)])
+        records = [record async for record in scanner.iter_scan(filename, include_files)]
+    finally:
+        scanner.close()
+    if any(deps != results[0] for deps in results):
+        sys.exit("concurrent scans differ")
+    if sorted(record.path for record in records) != sorted([filename] + include_files):
+        sys.exit("streamed files differ")
+    return results[0]
+print_conda_env(*asyncio.run(main()))
+EOF_PY
+) <(cat tests/all.yml)
+if [[ "$?" -eq "0" ]] ; then
+    log " Test succeeded for asynchronous scans!"
+else
+    report_error " Test failed for asynchronous scans."
+fi
+
+log " Comparing scans of the work tree and of a commit: conda_deps --rev HEAD tests"
+diff <(conda_deps --no-cache --rev HEAD tests) <(conda_deps --no-cache --git tests)
+# also when run as a module, which loads the package modules only once
+diff <(python -m conda_deps.conda_deps --no-cache --rev HEAD tests) <(conda_deps --no-cache --git tests)
+if [[ "$?" -eq "0" ]] ; then
+    log " Test succeeded for scanning a commit!"
+else
+    report_error " Test failed for scanning a commit."
+fi
+
+log " Checking dependency changes in a range of commits: conda_deps --history HEAD~2..HEAD"
+HIST_DIR=`mktemp -d`
+hist_commit() {
+    git -C $HIST_DIR add -A
+    git -C $HIST_DIR -c user.name=test -c user.email=test@example.com commit -q -m "$1"
+}
+git init -q $HIST_DIR
+echo "import numpy" > $HIST_DIR/first.py
+hist_commit "add numpy"
+echo "import pandas" > $HIST_DIR/second.py
+hist_commit "add pandas"
+rm $HIST_DIR/first.py
+hist_commit "remove numpy"
+# the oldest commit of the range is compared with its parent
+diff <(conda_deps --no-cache --history HEAD~2..HEAD $HIST_DIR | sed 's/^commit .*/commit/') \
+    <(printf "commit\n + pandas\ncommit\n - numpy\n")
+# a range from the first commit of the repository
+diff <(conda_deps --no-cache --history HEAD $HIST_DIR | sed 's/^commit .*/commit/') \
+    <(printf "commit\n + numpy\ncommit\n + pandas\ncommit\n - numpy\n")
+if [[ "$?" -eq "0" ]] ; then
+    log " Test succeeded for history of a range of commits!"
+else
+    report_error " Test failed for history of a range of commits."
+fi
+rm -rf $HIST_DIR
+
+log " Comparing scans of a folder and of an archive: conda_deps tests"
+ARC_DIR=`mktemp -d`
+tar czf $ARC_DIR/tests.tar.gz tests
+diff <(conda_deps --no-cache $ARC_DIR/tests.tar.gz) <(conda_deps --no-cache tests)
+if [[ "$?" -eq "0" ]] ; then
+    log " Test succeeded for scanning an archive!"
+else
+    report_error " Test failed for scanning an archive."
+fi
+rm -rf $ARC_DIR
+
+log " Comparing scans through symbolic links and loops: conda_deps --follow-symlinks"
+LINK_DIR=`mktemp -d`
+mkdir $LINK_DIR/sub
+ln -s $PWD/tests $LINK_DIR/sub/tests
+ln -s $PWD/tests $LINK_DIR/copy
+ln -s .. $LINK_DIR/sub/loop
+diff <(conda_deps --no-cache --follow-symlinks $LINK_DIR) <(conda_deps --no-cache tests)
+if [[ "$?" -eq "0" ]] ; then
+    log " Test succeeded for following symbolic links!"
+else
+    report_error " Test failed for following symbolic links."
+fi
+rm -rf $LINK_DIR
+
+log " Comparing scans by the daemon and by conda_deps: conda_deps_client $ALL"
+SERVE_DIR=`mktemp -d`
+export CONDA_DEPS_SOCKET=$SERVE_DIR/conda_deps.sock
+conda_deps serve &
+SERVE_PID=$!
+while [[ ! -S $CONDA_DEPS_SOCKET ]] ; do sleep 0.1 ; done
+diff <(conda_deps_client $ALL) <(cat tests/all.yml)
+diff <(conda_deps_client $ALL) <(cat tests/all.yml)
+if [[ "$?" -eq "0" ]] ; then
+    log " Test succeeded for daemon!"
+else
+    report_error " Test failed for daemon."
+fi
+
+log " Checking that rejected requests do not block the daemon: conda_deps_client --wat"
+WATCH_STATUS=0
+conda_deps_client --wat -o $SERVE_DIR/env.yml tests 2> /dev/null || WATCH_STATUS=$?
+SERVE_STATUS=0
+conda_deps_client serve 2> /dev/null || SERVE_STATUS=$?
+diff <(timeout 60 conda_deps_client $ALL) <(cat tests/all.yml)
+if [[ "$?" -eq "0" && "$WATCH_STATUS" -eq "2" && "$SERVE_STATUS" -eq "2" ]] ; then
+    log " Test succeeded for rejected requests!"
+else
+    report_error " Test failed for rejected requests."
+fi
+kill $SERVE_PID
+wait $SERVE_PID
+unset CONDA_DEPS_SOCKET
+rm -rf $SERVE_DIR